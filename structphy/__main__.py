@@ -1,151 +1,224 @@
 from pathlib import Path
 import click
 import os
-import multiprocessing
-import pandas as pd
 
-from structphy.install_executables import install_tmalign, install_fastme, install_consense
-from structphy.generate_matrices import generate_bootstrap_matrices_from_structures, make_fake_outgroups
-from structphy.generate_trees import matrices_to_fastme_newick
-from structphy.generate_consensus_tree import bootstrap_trees_to_consensus
-from structphy.branch_lengths import get_stacked, get_mean_distance_matrix, get_upgma_tree, optimise_branch_lengths
-from structphy.bootstrapping import bootstrap_against_tree
+# Only light imports up here. pandas, ete3 and the pipeline modules are imported
+# inside the stages that use them so --help and usage errors return instantly.
 
 
 TMALIGN_URL = 'https://zhanggroup.org/TM-align/TMalign.cpp'
 FASTME_URL = 'http://www.atgc-montpellier.fr/download/sources/fastme/fastme-2.1.6.4.tar.gz'
 CONSENSE_URL = 'http://evolution.gs.washington.edu/phylip/download/phylip-3.697.tar.gz'
 
+# Same names as metrics.METRICS and generate_trees.FASTME_METHODS, listed here so
+# checking the options doesn't import pandas
+METRIC_NAMES = ['tm_max', 'tm_min', 'tm_mean', 'tm_longer', 'tm_shorter', 'rmsd', 'seq_id', 'tm_seq_id']
+FASTME_METHOD_NAMES = ['NJ', 'BioNJ', 'UNJ', 'TaxAdd_BalME', 'TaxAdd_OLSME']
 
-def setup_working_dir():
+
+def setup_working_dir(tool_timeout: float = None):
     CWD = Path(os.getcwd())
     CACHE_DIR = CWD / ".structphy"
     os.environ["STRUCTPHY_CACHE_DIR"] = str(CACHE_DIR)
+    if tool_timeout is not None:
+        os.environ["STRUCTPHY_TOOL_TIMEOUT"] = str(tool_timeout)
     CACHE_DIR.mkdir(parents=False, exist_ok=True)
 
+    from structphy.install_executables import install_tmalign, install_fastme, install_consense
     # install_tmalign(CACHE_DIR, TMALIGN_URL) #.structphy/TMalign
     # install_fastme(CACHE_DIR, FASTME_URL) #.structphy/fastme
     # install_consense(CACHE_DIR, CONSENSE_URL) #.structphy/consense
 
 
     
-@click.command()
+@click.group(invoke_without_command=True)
+@click.pass_context
 @click.option('-d', '--structdir', type=click.Path(file_okay=False, path_type=Path, resolve_path=True))
 @click.option('-f', '--fasta', type=click.Path(exists=True,  path_type=Path, resolve_path=True))
 @click.option('-dm', '--dmdir', type=click.Path(file_okay=False, path_type=Path, resolve_path=True))
 @click.option('-o', '--outtree', type=click.Path(exists=True,  path_type=Path, resolve_path=True))
-@click.option('-t', '--threads', type=int, default=multiprocessing.cpu_count())
+@click.option('-t', '--threads', type=int, default=os.cpu_count())
 @click.option('-n', '--n_bootstraps', type=int, default=10)
 @click.option('--n_variants', type=int, default=10)
 @click.option('--drop_inserts', is_flag=True, show_default=True, default=False)
 @click.option('--fold_dir', type=click.Path(file_okay=False, path_type=Path, resolve_path=True))
 @click.option('--dropout', type=str)
-def main(structdir: Path, fold_dir: Path, fasta: Path, dmdir: Path, outtree: Path, threads: int, n_bootstraps: int, drop_inserts: bool, dropout: str, n_variants: int):
-    setup_working_dir()
-
-    if ((structdir is None) is (fasta is None)) and not dmdir: #XOR check, has to be one or the other
+@click.option('--fold_backend', type=click.Choice(['docker', 'local', 'stub']), default='docker', show_default=True, help='Inference backend, stub writes placeholder PDBs for testing without a GPU.')
+@click.option('--fold_workers', type=int, default=1, show_default=True, help='Concurrent inference workers, each docker worker gets its own GPU when more than one.')
+@click.option('--fold_command', type=str, help='Command template for the local backend, filled with {fasta}, {out_dir}, {max_tokens}, {dropout} and {worker}.')
+@click.option('--max_tokens_per_batch', type=int, default=1300, show_default=True)
+@click.option('--tool_timeout', type=float, default=3600.0, show_default=True, help='Seconds a single TMalign, fastme or consense run may take before it is killed, 0 for no limit.')
+@click.option('-p', '--pairdir', type=click.Path(exists=True, file_okay=False, path_type=Path, resolve_path=True), help='Reuse pair results stored by an earlier run instead of aligning.')
+@click.option('-m', '--metric', type=click.Choice(METRIC_NAMES), default='tm_max', show_default=True, help='Distance derived from the TMalign results.')
+@click.option('--method', type=click.Choice(FASTME_METHOD_NAMES), default='NJ', show_default=True, help='FastME tree building method.')
+@click.option('--support', type=click.Choice(['classic', 'tbe']), default='classic', show_default=True, help='Branch support, classic clade frequency or transfer bootstrap expectation (better suited to large trees).')
+def main(ctx: click.Context, structdir: Path, fold_dir: Path, fasta: Path, dmdir: Path, outtree: Path, threads: int, n_bootstraps: int, drop_inserts: bool, dropout: str, n_variants: int, pairdir: Path, metric: str, method: str, support: str, fold_backend: str, fold_workers: int, fold_command: str, max_tokens_per_batch: int, tool_timeout: float):
+    # Subcommands like `structphy sweep` handle their own setup
+    if ctx.invoked_subcommand is not None:
+        return
+
+    setup_working_dir(tool_timeout)
+
+    if ((structdir is None) is (fasta is None)) and not dmdir and not pairdir: #XOR check, has to be one or the other
         raise click.UsageError('Either a directory of structures (--structdir mydir/), OR a fasta file of sequences (--fasta myseqs.fa) needs to be provided.')
     
     if fasta:
-        from structphy.run_inference_docker import run_esm_dropouts
-        from structphy.fasta_loading import fasta_to_dict, fasta_dict_to_bootstrap_string
-        from structphy.extract_conserved_pdb import remove_inserts_from_structure
-
-        # Read fasta file into a dict like {id: sequence, ...}
-        fasta_dict_full, fasta_dict_no_gaps = fasta_to_dict(fasta)
-        
         # If a directory for the folding files isn't given make one at ./fastaname_folddir/
         if not fold_dir:
             fold_dir = Path(os.getcwd()) / (fasta.name.split('.')[0] + '_folddir')
             if not os.path.exists(fold_dir):
                 os.mkdir(fold_dir)
                 click.echo(f'Folding bootstraps into {fold_dir}')
-        # Directory has to be empty to avoid mixing up old and new PDBs
-        if os.listdir(fold_dir):
+        # Directory has to be empty to avoid mixing up old and new PDBs,
+        # unless it holds an interrupted fold, then only the unfinished records are folded
+        from structphy.fold_scheduler import MANIFEST_NAME, unrequested_records
+        if os.listdir(fold_dir) and not (fold_dir / MANIFEST_NAME).exists():
             raise click.UsageError(f'Tried to use {fold_dir}, but it wasn\'t empty.')
+        if (fold_dir / MANIFEST_NAME).exists():
+            from structphy.fasta_loading import fasta_to_dict, iter_bootstrap_records
+            unrequested = unrequested_records(fold_dir, (id for id, _ in iter_bootstrap_records(fasta_to_dict(fasta)[0], n_variants)))
+            if unrequested:
+                raise click.UsageError(f'{fold_dir} holds {len(unrequested)} records from a different fold ({", ".join(unrequested[:5])}), use a new --fold_dir.')
+        if fold_backend == 'local' and not fold_command:
+            raise click.UsageError('--fold_backend local needs a --fold_command template.')
 
-        # Write bootstrap fasta temporarily to the fold_dir
-        bootstrap_fasta_out = fasta_dict_to_bootstrap_string(fasta_dict_no_gaps, n_variants)
-        bootstrap_fasta_path = fold_dir / 'bootstraps.fasta'
-        with open(bootstrap_fasta_path, 'w') as f:
-            f.write(bootstrap_fasta_out)
-
-        
-        # Run inference into 'fold_dir'
         if dropout:
             dropout = [float(x) for x in dropout.split(',')]
 
-        click.echo('Pulling and folding using docker image \'finnod/structphy-esmdropouts-openfold\'')
-        structdir = run_esm_dropouts( #fasta_in and output_dir_name must be in share_dir for docker!
-            share_dir=fold_dir,
-            fasta_in=bootstrap_fasta_path,
-            dropout=dropout,
-            max_tokens_per_batch=1300, #click option or maybe auto? not sure
-        )
-
-        # Remove bootstraps.fa file in fold_dir after structures are made
-        os.remove(bootstrap_fasta_path)
-        structdir = fold_dir
-
-        # if remove inserts, make a new _conserved directory then strip the inserts from the folded directory
-        if drop_inserts:
-            full_pdbs = [(fold_dir / file).resolve() for file in os.listdir(fold_dir) if file.endswith('.pdb')]
-            out_conserved_dir = fold_dir.parent / (fold_dir.stem + '_conserved')
-            out_conserved_dir.mkdir(exist_ok=True)
-            for fulL_pdb_file in full_pdbs:
-                pdb_name = fulL_pdb_file.name
-                id = fulL_pdb_file.stem.split('#')[0]
-                pdb_file_out = out_conserved_dir / pdb_name
-                remove_inserts_from_structure(fulL_pdb_file,  fasta_dict_full[id], pdb_file_out)
-            
-            structdir = out_conserved_dir
- 
-    if dmdir is None:
-        structure_files = [(structdir / file).resolve() for file in os.listdir(structdir) if file.endswith('.pdb')]
-
-        bootstrap_matrices = generate_bootstrap_matrices_from_structures(structure_files, n_threads=threads, n_bootstraps=n_bootstraps)
-    else:
-        click.echo(f'Reading distance matrices from {dmdir}')
-        bootstrap_matrices_files = [(dmdir / file).resolve() for file in os.listdir(dmdir) if file.endswith('.csv')]
-        bootstrap_matrices = [pd.read_csv(filename, index_col='Unnamed: 0') for filename in bootstrap_matrices_files]
-
-    stacked_matrices = get_stacked(bootstrap_matrices)
-    mean_distance_matrix = get_mean_distance_matrix(stacked_matrices)
-    
-    if dmdir is None:
-        Path('bootstrap_matrices/').mkdir(exist_ok='True')
-        for i, matrix in enumerate(bootstrap_matrices):
-            matrix.to_csv(f'bootstrap_matrices/bootstrap_matrix_{i}.csv', float_format='%.8G')
-
-    # Fake outgroups
-    fake_outgroup_name = '!_OUTGROUP_!'
-    bootstrap_matrices = make_fake_outgroups(bootstrap_matrices,fake_outgroup_name )
-
-    # generate trees from matrices
-    bootstrap_trees = matrices_to_fastme_newick(bootstrap_matrices, n_threads=threads)
-    with open('bootstrap_trees.newick', 'w') as f:
-        for tree in bootstrap_trees:
-            f.write(tree+'\n')
-
-
-    # generate consensus tree from bootstrap trees
-    consensus_tree = bootstrap_trees_to_consensus(bootstrap_trees, outgroup_name=fake_outgroup_name)
-    with open('consensus_tree.newick', 'w') as f:
-        f.write(consensus_tree)
-
-    # reweight the consensus branch lengths using distance matrices and optimise routine
-    # use flag for upgma vs leastsq
-    upgma_tree = get_upgma_tree(consensus_tree, mean_distance_matrix)
-    with open(outtree if outtree else 'upgma_tree.newick', 'w') as f:
-        f.write(upgma_tree)
-
-    # optimised_tree = optimise_branch_lengths(upgma_tree, mean_distance_matrix.to_numpy())
-    # print(optimised_tree)
-
-    # bootstrap against the consensus tree
-    # Must be last as ete3 can't read this bootstrap format.
-    bootstrapped_tree = bootstrap_against_tree(bootstrap_trees, upgma_tree)
-    with open(outtree if outtree else 'boostrapped_upgma_tree.newick', 'w') as f:
-        f.write(bootstrapped_tree)
-
-    
\ No newline at end of file
+    from structphy.pipeline import run_pipeline
+    run_pipeline(
+        Path('.'),
+        n_threads=threads,
+        structdir=structdir,
+        fasta=fasta,
+        fold_dir=fold_dir,
+        dmdir=dmdir,
+        pairdir=pairdir,
+        n_bootstraps=n_bootstraps,
+        n_variants=n_variants,
+        drop_inserts=drop_inserts,
+        dropout=dropout,
+        metric=metric,
+        method=method,
+        support=support,
+        outtree=outtree,
+        fold_options={'backend': fold_backend, 'n_workers': fold_workers, 'max_tokens_per_batch': max_tokens_per_batch, 'fold_command': fold_command},
+    )
+
+@main.command()
+@click.option('-g', '--grid', type=click.Path(exists=True, dir_okay=False, path_type=Path, resolve_path=True), required=True, help='JSON file with lists of values for dropout, drop_inserts, n_bootstraps, metric, method and support.')
+@click.option('-d', '--structdir', type=click.Path(file_okay=False, path_type=Path, resolve_path=True))
+@click.option('-f', '--fasta', type=click.Path(exists=True,  path_type=Path, resolve_path=True))
+@click.option('--outdir', type=click.Path(file_okay=False, path_type=Path, resolve_path=True), default='sweep', show_default=True)
+@click.option('-t', '--threads', type=int, default=os.cpu_count())
+@click.option('--n_variants', type=int, default=10)
+@click.option('--fold_backend', type=click.Choice(['docker', 'local', 'stub']), default='docker', show_default=True)
+@click.option('--fold_workers', type=int, default=1, show_default=True)
+@click.option('--fold_command', type=str)
+@click.option('--max_tokens_per_batch', type=int, default=1300, show_default=True)
+@click.option('--tool_timeout', type=float, default=3600.0, show_default=True, help='Seconds a single TMalign, fastme or consense run may take before it is killed, 0 for no limit.')
+def sweep(grid: Path, structdir: Path, fasta: Path, outdir: Path, threads: int, n_variants: int, fold_backend: str, fold_workers: int, fold_command: str, max_tokens_per_batch: int, tool_timeout: float):
+    """Run a grid of settings, computing shared stages only once."""
+    setup_working_dir(tool_timeout)
+
+    if (structdir is None) is (fasta is None):
+        raise click.UsageError('Either a directory of structures (--structdir mydir/), OR a fasta file of sequences (--fasta myseqs.fa) needs to be provided.')
+
+    from structphy.sweep import load_grid, run_sweep
+
+    try:
+        sweep_grid = load_grid(grid)
+        outdir.mkdir(parents=True, exist_ok=True)
+        fold_options = {'backend': fold_backend, 'n_workers': fold_workers, 'max_tokens_per_batch': max_tokens_per_batch, 'fold_command': fold_command}
+        run_sweep(sweep_grid, outdir, n_threads=threads, structdir=structdir, fasta=fasta, n_variants=n_variants, fold_options=fold_options)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+@main.command()
+@click.option('-d', '--structdir', type=click.Path(exists=True, file_okay=False, path_type=Path, resolve_path=True))
+@click.option('-f', '--fasta', type=click.Path(exists=True,  path_type=Path, resolve_path=True))
+@click.option('-n', '--n_bootstraps', type=int, default=10)
+@click.option('--n_variants', type=int, default=10)
+@click.option('-t', '--threads', type=int, default=os.cpu_count())
+@click.option('--method', type=click.Choice(FASTME_METHOD_NAMES), default='NJ', show_default=True)
+@click.option('--support', type=click.Choice(['classic', 'tbe']), default='classic', show_default=True)
+@click.option('--max_tokens_per_batch', type=int, default=1300, show_default=True)
+@click.option('--calibrate/--no_calibrate', default=True, show_default=True, help='Time TMalign, fastme and the support stage on this machine instead of using built in costs.')
+@click.option('--json', 'json_out', type=click.Path(dir_okay=False, path_type=Path), help='Also write the plan as JSON.')
+def plan(structdir: Path, fasta: Path, n_bootstraps: int, n_variants: int, threads: int, method: str, support: str, max_tokens_per_batch: int, calibrate: bool, json_out: Path):
+    """Predict pair counts, run time, memory and disk for a run, without running it."""
+    setup_working_dir()
+
+    if (structdir is None) is (fasta is None):
+        raise click.UsageError('Either a directory of structures (--structdir mydir/), OR a fasta file of sequences (--fasta myseqs.fa) needs to be provided.')
+
+    import json
+    from structphy import planner
+    from structphy.pipeline import list_structure_files
+
+    structure_files = list_structure_files(structdir) if structdir else []
+    lengths = planner.lengths_from_structures(structure_files) if structdir else planner.lengths_from_fasta(fasta, n_variants)
+    if len(lengths) < 2:
+        raise click.UsageError('Need at least two proteins to plan a tree.')
+
+    tmalign_cost, fastme_cost = planner.DEFAULT_TMALIGN_COST, planner.DEFAULT_FASTME_COST
+    support_cost = planner.DEFAULT_SUPPORT_COSTS[support]
+    if calibrate:
+        support_cost = planner.calibrate_support(len(lengths), support=support)
+        cache_dir = Path(os.environ["STRUCTPHY_CACHE_DIR"])
+        if (cache_dir / 'TMalign').exists():
+            tmalign_cost = planner.calibrate_tmalign(structure_files, cache_dir / 'TMalign')
+        else:
+            click.echo(f'No TMalign in {cache_dir}, using built in alignment costs')
+        if (cache_dir / 'fastme').exists():
+            fastme_cost = planner.calibrate_fastme(len(lengths) + 1, method=method)
+        else:
+            click.echo(f'No fastme in {cache_dir}, using built in tree costs')
+
+    run_plan = planner.make_plan(
+        lengths,
+        n_bootstraps=n_bootstraps,
+        n_threads=threads,
+        tmalign_cost=tmalign_cost,
+        fastme_cost=fastme_cost,
+        fold=fasta is not None,
+        max_tokens_per_batch=max_tokens_per_batch,
+        support=support,
+        support_cost=support_cost,
+    )
+    planner.print_plan(run_plan)
+
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(run_plan, f, indent=2)
+
+@main.command()
+@click.option('--host', type=str, default='127.0.0.1', show_default=True)
+@click.option('--port', type=int, default=8765, show_default=True)
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False, path_type=Path, resolve_path=True), help='Listen on a Unix socket instead of host and port.')
+@click.option('--root', type=click.Path(file_okay=False, path_type=Path, resolve_path=True), default='structphy_jobs', show_default=True, help='Each job runs in its own directory under here.')
+@click.option('-t', '--threads', type=int, default=os.cpu_count(), help='TMalign and fastme children, split evenly between running jobs, and workers in the transfer bootstrap pool started by the first tbe job.')
+@click.option('--max_jobs', type=int, default=2, show_default=True, help='Jobs run at the same time.')
+@click.option('--tool_timeout', type=float, default=3600.0, show_default=True, help='Seconds a single TMalign, fastme or consense run may take before it is killed, 0 for no limit.')
+@click.option('--fold_backend', type=click.Choice(['docker', 'local', 'stub']), default='docker', show_default=True, help='How jobs with a fasta are folded, jobs can\'t change it.')
+@click.option('--fold_command', type=str, help='Command template for the local backend, filled with {fasta}, {out_dir}, {max_tokens}, {dropout} and {worker}.')
+@click.option('--token', type=str, envvar='STRUCTPHY_SERVICE_TOKEN', help='Token clients send as Authorization: Bearer <token>. Defaults to one generated into the root directory.')
+def serve(host: str, port: int, socket_path: Path, root: Path, threads: int, max_jobs: int, tool_timeout: float, fold_backend: str, fold_command: str, token: str):
+    """Keep workers and caches warm and run jobs submitted over a local HTTP API."""
+    if fold_backend == 'local' and not fold_command:
+        raise click.UsageError('--fold_backend local needs a --fold_command template.')
+    setup_working_dir(tool_timeout)
+
+    from structphy.service import JobService, TOKEN_NAME, load_token, serve as serve_jobs
+
+    if not token:
+        token = load_token(root)
+        print(f'Clients authenticate with the token in {root / TOKEN_NAME}')
+
+    service = JobService(root, n_threads=threads, max_jobs=max_jobs, fold_backend=fold_backend, fold_command=fold_command)
+    service.start()
+    serve_jobs(service, token, host=host, port=port, socket_path=socket_path)
+
+
+if __name__ == '__main__':
+    main()
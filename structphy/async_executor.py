@@ -0,0 +1,145 @@
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Sequence
+import asyncio
+import os
+import signal
+import subprocess
+
+from tqdm.auto import tqdm
+
+# Seconds any single TMalign, fastme or consense run may take before it is killed
+DEFAULT_TOOL_TIMEOUT = 3600.0
+
+
+def tool_timeout() -> Optional[float]:
+    # Set per run with --tool_timeout, 0 turns the limit off
+    timeout = float(os.environ.get('STRUCTPHY_TOOL_TIMEOUT', DEFAULT_TOOL_TIMEOUT))
+    return timeout if timeout > 0 else None
+
+def kill_process_group(process: asyncio.subprocess.Process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, ProcessLookupError, PermissionError):
+        # No process groups (Windows), or it has already gone
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+async def run_subprocess_async(
+        command: Sequence[str],
+        input: Optional[bytes] = None,
+        cwd: Optional[Path] = None,
+        timeout: Optional[float] = None,
+    ) -> subprocess.CompletedProcess:
+
+    process = await asyncio.create_subprocess_exec(
+        *[str(x) for x in command],
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=str(cwd) if cwd else None,
+        # Own process group, so anything the tool starts is killed with it
+        start_new_session=True,
+    )
+
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(command, timeout)
+    finally:
+        # Don't leave orphaned children around when a tool hangs or the run is cancelled (e.g. Ctrl-C)
+        if process.returncode is None:
+            kill_process_group(process)
+            await process.wait()
+
+    return subprocess.CompletedProcess(command, process.returncode, stdout.decode(), stderr.decode())
+
+async def run_subprocesses_async(
+        commands: Sequence[Sequence[str]],
+        parse: Callable[[subprocess.CompletedProcess], Any],
+        n_concurrent: int,
+        inputs: Optional[Sequence[Optional[bytes]]] = None,
+        cwd: Optional[Path] = None,
+        timeout: Optional[float] = None,
+        retries: int = 0,
+        desc: Optional[str] = None,
+        leave: bool = True,
+    ) -> List[Any]:
+
+    n_concurrent = max(1, n_concurrent)
+    results = [None] * len(commands)
+
+    # The queue is bounded so the producer waits for free children instead of
+    # building a coroutine for every command up front
+    queue = asyncio.Queue(maxsize=2 * n_concurrent)
+    progress = tqdm(total=len(commands), desc=desc, leave=leave, ascii=True, disable=desc is None)
+
+    errors = []
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+
+            i, command = item
+            # After a failure the remaining queue is only drained so the producer never blocks
+            if errors:
+                continue
+
+            input = inputs[i] if inputs is not None else None
+            for attempt in range(retries + 1):
+                try:
+                    completed = await run_subprocess_async(command, input=input, cwd=cwd, timeout=timeout)
+                    completed.check_returncode()
+                    # Output is parsed here in the event loop, no results are sent between processes
+                    results[i] = parse(completed)
+                    break
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                    if attempt == retries:
+                        errors.append(e)
+                except Exception as e:
+                    errors.append(e)
+                    break
+            progress.update(1)
+
+    try:
+        workers = [asyncio.create_task(worker()) for _ in range(n_concurrent)]
+        for i, command in enumerate(commands):
+            await queue.put((i, command))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        progress.close()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+def run_subprocesses(
+        commands: Sequence[Sequence[str]],
+        parse: Callable[[subprocess.CompletedProcess], Any],
+        n_concurrent: int,
+        inputs: Optional[Sequence[Optional[bytes]]] = None,
+        cwd: Optional[Path] = None,
+        timeout: Optional[float] = None,
+        retries: int = 0,
+        desc: Optional[str] = None,
+        leave: bool = True,
+    ) -> List[Any]:
+    # Run external tools with at most n_concurrent children alive at a time.
+    # Results are returned in the same order as commands.
+    return asyncio.run(run_subprocesses_async(
+        commands,
+        parse=parse,
+        n_concurrent=n_concurrent,
+        inputs=inputs,
+        cwd=cwd,
+        timeout=timeout,
+        retries=retries,
+        desc=desc,
+        leave=leave,
+    ))
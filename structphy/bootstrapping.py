@@ -20,9 +20,7 @@ def list_subtree_sets(tree):
   
   return sets
 
-def bootstrap_against_tree(bootstrap_trees_newick, base_tree_newick):
-
-    base_tree = Tree(base_tree_newick)
+def classic_supports(bootstrap_trees_newick, base_tree):
 
     base_subtrees = list_subtree_sets(base_tree)
     bootstrap_counts = {cluster:[] for cluster in base_subtrees}
@@ -38,6 +36,20 @@ def bootstrap_against_tree(bootstrap_trees_newick, base_tree_newick):
                 bootstrap_counts[base_cluster].append(0)
 
     bootstrap_ratios = {cluster:sum(hits)/len(hits) for cluster, hits in bootstrap_counts.items()}
+    return bootstrap_ratios
+
+def bootstrap_against_tree(bootstrap_trees_newick, base_tree_newick, support='classic', n_threads=1, pool=None):
+
+    base_tree = Tree(base_tree_newick)
+
+    # classic counts exact clade matches, tbe is the transfer bootstrap expectation
+    if support == 'classic':
+        bootstrap_ratios = classic_supports(bootstrap_trees_newick, base_tree)
+    elif support == 'tbe':
+        from structphy.transfer_bootstrap import transfer_supports
+        bootstrap_ratios = transfer_supports(bootstrap_trees_newick, base_tree_newick, n_threads=n_threads, pool=pool)
+    else:
+        raise ValueError(f'Unknown support {support!r}, expected classic or tbe')
 
     out_tree = base_tree.copy()
 
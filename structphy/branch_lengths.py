@@ -2,8 +2,6 @@ from typing import List
 import pandas as pd
 import numpy as np
 from ete3 import Tree
-from phylodm import PhyloDM
-import dendropy
 
 from structphy.bootstrapping import list_subtree_sets
 
@@ -92,6 +90,8 @@ def get_branch_lengths(tree):
     return list(subtree_lengths.values())
 
 def get_pdm_matrix(new_branch_lengths: List[float], base_tree: Tree):
+  from phylodm import PhyloDM
+  import dendropy
 
   new_tree = branch_lengths_on_tree(new_branch_lengths, base_tree)
   dentropy_tree = dendropy.Tree.get(data=new_tree.write(format = 0), schema = 'newick')
@@ -125,6 +125,8 @@ def optimise_branch_lengths(base_tree_newick: str, mean_distance_matrix: np.arra
         new_branch_lengths = np.array(list(params.valuesdict().values()))
         return residuals(new_branch_lengths)
     
+    from phylodm import PhyloDM
+    import dendropy
     from lmfit import minimize, Parameters, fit_report
     import lmfit
     import math
@@ -0,0 +1,47 @@
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+import hashlib
+
+
+def structure_fingerprint(pdb_filename: Path, decimals: int = 3) -> str:
+  # Hash only what TMalign sees: atom and residue names, residue numbers and coordinates.
+  # Headers, atom serials, chain ids, occupancies and B-factors (pLDDT for folded
+  # structures) are ignored, so re-folds that only differ there collapse together.
+  digest = hashlib.blake2b(digest_size=16)
+
+  with open(pdb_filename) as f:
+    for line in f:
+      if not line.startswith(('ATOM', 'HETATM')):
+        continue
+
+      atom_name = line[12:16].strip()
+      res_name = line[17:20]
+      res_num = line[22:27].strip()
+      coords = (round(float(line[30:38]), decimals), round(float(line[38:46]), decimals), round(float(line[46:54]), decimals))
+      digest.update(f'{atom_name} {res_name} {res_num} {coords[0]:.{decimals}f} {coords[1]:.{decimals}f} {coords[2]:.{decimals}f}\n'.encode())
+
+  return digest.hexdigest()
+
+def deduplicate_structures(structure_files: List[Path], decimals: int = 3) -> Tuple[Dict[Path, Path], Dict[Path, int], Dict[Path, str]]:
+  # Returns ({structure: representative}, {representative: multiplicity}, {structure: fingerprint})
+  # The representative of each group is the first structure in sorted order so the choice is stable between runs.
+  representative_by_hash = {}
+  representatives = {}
+  multiplicity = {}
+  fingerprints = {}
+
+  for structure_file in sorted(structure_files):
+    fingerprint = structure_fingerprint(structure_file, decimals=decimals)
+    representative = representative_by_hash.setdefault(fingerprint, structure_file)
+    representatives[structure_file] = representative
+    multiplicity[representative] = multiplicity.get(representative, 0) + 1
+    fingerprints[structure_file] = fingerprint
+
+  return representatives, multiplicity, fingerprints
+
+def canonical_pair(pdb_a: Union[Path, str], pdb_b: Union[Path, str]) -> Tuple[tuple, bool]:
+  # Alignments are stored once per unordered pair of structures or fingerprints,
+  # the flag says whether the request was swapped
+  if str(pdb_a) <= str(pdb_b):
+    return (pdb_a, pdb_b), False
+  return (pdb_b, pdb_a), True
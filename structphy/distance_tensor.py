@@ -0,0 +1,63 @@
+from typing import List
+import numpy as np
+import pandas as pd
+
+# Bootstrap distance matrices stacked into one B x N x N float64 array. Each stage reads
+# views of it (phylip text for fastme, csv output, the mean matrix) instead of a separate
+# DataFrame per bootstrap. Taxa are the protein ids (no '#variant'), in the same order on
+# both axes of every matrix.
+
+
+def taxon_name(structure_name: str) -> str:
+    return structure_name.split('#')[0]
+
+class DistanceTensor:
+
+    def __init__(self, values: np.ndarray, taxa: List[str], labels: List[List[str]] = None):
+        self.values = values
+        self.shape = values.shape
+        self.taxa = list(taxa)
+        # Structure names sampled for each bootstrap, e.g. 'ARAF#3'
+        self.labels = labels
+
+    @classmethod
+    def create(cls, n_bootstraps: int, taxa: List[str], labels: List[List[str]] = None) -> 'DistanceTensor':
+        return cls(np.zeros((n_bootstraps, len(taxa), len(taxa))), taxa, labels=labels)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def head(self, n_bootstraps: int) -> 'DistanceTensor':
+        # The first n bootstraps, a view rather than a copy
+        return DistanceTensor(self.values[:n_bootstraps], self.taxa, labels=self.labels[:n_bootstraps] if self.labels else None)
+
+    def matrix(self, i: int) -> pd.DataFrame:
+        # A DataFrame over the stacked array, not a copy
+        names = self.labels[i] if self.labels else self.taxa
+        return pd.DataFrame(self.values[i], index=names, columns=names, copy=False)
+
+    def mean_matrix(self) -> pd.DataFrame:
+        return pd.DataFrame(self.values.mean(axis=0), index=self.taxa, columns=self.taxa)
+
+    def close(self):
+        # Drops the array so a cached tensor doesn't keep it alive
+        self.values = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def tensor_from_dataframes(distance_dfs: List[pd.DataFrame]) -> DistanceTensor:
+    # For matrices read from csv, rows and columns are matched by protein id, not position
+    taxa = sorted(taxon_name(str(name)) for name in distance_dfs[0].index)
+    labels = []
+    tensor = DistanceTensor.create(len(distance_dfs), taxa)
+    for i, distance_df in enumerate(distance_dfs):
+        by_taxon = {taxon_name(str(name)): name for name in distance_df.index}
+        ordered = [by_taxon[taxon] for taxon in taxa]
+        tensor.values[i] = distance_df.loc[ordered, ordered].to_numpy(dtype=float)
+        labels.append([str(name) for name in ordered])
+    tensor.labels = labels
+    return tensor
@@ -1,4 +1,7 @@
 from pathlib import Path
+import numpy as np
+
+from structphy.fasta_loading import sequence_masks
 
 aa_dict = {
     'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D',
@@ -8,7 +11,13 @@ aa_dict = {
     'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V'
 }
 
-def remove_inserts_from_structure(pdb_filename: Path, manual_alignment: str, output_pdb_filename: Path):
+def remove_inserts_from_structure(pdb_filename: Path, manual_alignment: str, output_pdb_filename: Path, gap_mask: np.ndarray = None, insert_mask: np.ndarray = None):
+  # gap_mask and insert_mask are from fasta_loading.sequence_masks, pass them in when
+  # stripping several structures folded from the same alignment row
+  if gap_mask is None or insert_mask is None:
+    gap_mask, insert_mask = sequence_masks(manual_alignment)
+  # Residues to keep, indexed by residue number - 1
+  keep = ~insert_mask[~gap_mask]
 
   with open(pdb_filename) as f:
     full_pdb_lines = f.readlines()
@@ -39,7 +48,7 @@ def remove_inserts_from_structure(pdb_filename: Path, manual_alignment: str, out
 
     fasta_res = fasta_seq[pdb_res_num-1]
     assert fasta_res.upper() == pdb_res
-    if fasta_res.isupper():
+    if keep[pdb_res_num-1]:
       out_lines.append(line)
 
   ter_line = f'TER    {pdb_atm_num}      {pdb_res_long} A {pdb_res_num}\n'
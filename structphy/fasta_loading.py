@@ -1,27 +1,54 @@
 from pathlib import Path
-from typing import Tuple, Dict
-import re
+from typing import Tuple, Dict, Iterable, Iterator
+import numpy as np
 
-def fasta_to_dict(fasta_file: Path) -> Tuple[Dict[str, str], Dict[str, str]]:
-    
+GAP = ord('-')
+
+def iter_fasta(fasta_file: Path) -> Iterator[Tuple[str, str]]:
+    # Streams (id, sequence) pairs, sequences may be wrapped over several lines
+    id = None
+    chunks = []
     with open(fasta_file, 'r') as f:
-            fasta_read = f.read()
-    id_seq = ([id_seq.strip() for id_seq in fasta_read.split('>') if id_seq.strip()])
-    id_seq_items = [[split for split in id_seq_pair.split('\n') if split] for id_seq_pair in id_seq]
-    fasta_dict_full = {id_seq_pair[0]:id_seq_pair[1] for id_seq_pair in id_seq_items}
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                if id is not None:
+                    yield id, ''.join(chunks)
+                id = line[1:].strip()
+                chunks = []
+            elif id is not None:
+                chunks.append(line)
+    if id is not None:
+        yield id, ''.join(chunks)
+
+def sequence_masks(sequence: str) -> Tuple[np.ndarray, np.ndarray]:
+    # (gap_mask, insert_mask), True at alignment columns that are gaps ('-') or inserts (lowercase)
+    residues = np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8)
+    gap_mask = residues == GAP
+    insert_mask = (residues >= ord('a')) & (residues <= ord('z'))
+    return gap_mask, insert_mask
+
+def fasta_to_dict(fasta_file: Path) -> Tuple[Dict[str, str], Dict[str, str]]:
+
+    fasta_dict_full = dict(iter_fasta(fasta_file))
 
     # Keep gaps ('-') and inserts (lowercase) in fasta_dict
     # Remove the gaps and uppercase inserts in fasta_dict_no_gaps
     fasta_dict_no_gaps = {id: seq.replace('-', '').upper() for id, seq in fasta_dict_full.items()}
-    
-    return fasta_dict_full, fasta_dict_no_gaps
 
-def fasta_dict_to_bootstrap_string(fasta_dict: Dict[str, str], n_bootstraps: int) -> str:
+    return fasta_dict_full, fasta_dict_no_gaps
 
-    bootstrap_fasta_out = ''
+def iter_bootstrap_records(fasta_dict: Dict[str, str], n_bootstraps: int) -> Iterator[Tuple[str, str]]:
+    # One (id#i, sequence) record per variant to fold
     for id, seq in fasta_dict.items():
         for i in range(n_bootstraps):
-            bootstrap_fasta_out += f'>{id}#{i}\n'
-            bootstrap_fasta_out += seq + '\n\n'
-    
-    return bootstrap_fasta_out
\ No newline at end of file
+            yield f'{id}#{i}', seq
+
+def write_fasta(records: Iterable[Tuple[str, str]], fasta_file: Path) -> Path:
+    # Writes (id, sequence) records to fasta_file, e.g. one shard of the fold scheduler
+    with open(fasta_file, 'w') as f:
+        for id, seq in records:
+            f.write(f'>{id}\n{seq}\n\n')
+    return fasta_file
@@ -0,0 +1,217 @@
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import math
+import queue
+import random
+import shlex
+import shutil
+import subprocess
+import threading
+import uuid
+
+from structphy.extract_conserved_pdb import aa_dict
+from structphy.fasta_loading import iter_fasta, write_fasta
+
+# A backend folds one shard fasta into {id}.pdb files in out_dir.
+# Called as backend(shard_fasta, out_dir, worker_id), worker ids are 0..n_workers-1.
+FoldBackend = Callable[[Path, Path, int], None]
+
+MANIFEST_NAME = 'fold_manifest.json'
+SHARD_DIR_NAME = '.shards'
+
+
+def pack_batches(records: List[Tuple[str, str]], max_tokens_per_batch: int) -> List[List[Tuple[str, str]]]:
+    # Sort by length so each batch holds sequences of similar length, then fill batches
+    # until the padded size (batch size * longest sequence) would go over the token budget.
+    # Sequences longer than the budget get a batch to themselves.
+    batches = []
+    batch = []
+    for id, seq in sorted(records, key=lambda record: len(record[1]), reverse=True):
+        longest = len(batch[0][1]) if batch else len(seq)
+        if batch and (len(batch) + 1) * longest > max_tokens_per_batch:
+            batches.append(batch)
+            batch = []
+        batch.append((id, seq))
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def make_shards(batches: List[List[Tuple[str, str]]], n_shards: int) -> List[List[Tuple[str, str]]]:
+    # Longest processing time first, each batch goes to the shard with the fewest tokens so far
+    shards = [[] for _ in range(n_shards)]
+    shard_tokens = [0] * n_shards
+    for batch in sorted(batches, key=lambda batch: sum(len(seq) for _, seq in batch), reverse=True):
+        lightest = shard_tokens.index(min(shard_tokens))
+        shards[lightest].extend(batch)
+        shard_tokens[lightest] += sum(len(seq) for _, seq in batch)
+
+    return [shard for shard in shards if shard]
+
+def load_manifest(out_dir: Path) -> Dict[str, str]:
+    manifest_path = out_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def unrequested_records(out_dir: Path, ids: Iterable[str]) -> List[str]:
+    # Records in out_dir's manifest that aren't among ids, e.g. left by a run with more variants
+    return sorted(set(load_manifest(out_dir)) - set(ids))
+
+def save_manifest(out_dir: Path, manifest: Dict[str, str]):
+    # Write then rename so an interrupted run never leaves a half written manifest
+    manifest_path = out_dir / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    tmp_path.replace(manifest_path)
+
+def schedule_folds(
+        records: List[Tuple[str, str]],
+        out_dir: Path,
+        backend: FoldBackend,
+        n_workers: int = 1,
+        max_tokens_per_batch: int = 1300,
+        shards_per_worker: int = 1,
+        max_retries: int = 2,
+    ) -> Dict[str, str]:
+    # Folds every (id, sequence) record into out_dir/{id}.pdb. Returns the manifest, {id: 'done'|'failed'}.
+    # Records already marked done in out_dir's manifest are skipped, so rerunning only folds what failed.
+    # Every shard is a separate backend call that loads the model again (a new container for docker),
+    # so by default each worker gets one shard, balanced by tokens. More shards per worker only pay
+    # off when a backend is cheap to start and folding times are hard to predict.
+
+    # A manifest from a run with other records would leave its structures in out_dir to be
+    # aligned with these, so only a resume of the same records is allowed
+    unrequested = unrequested_records(out_dir, (id for id, _ in records))
+    if unrequested:
+        raise ValueError(f'{out_dir} holds {len(unrequested)} records from a different fold ({", ".join(unrequested[:5])}), use a new fold directory')
+
+    manifest = load_manifest(out_dir)
+    manifest_lock = threading.Lock()
+    pending = [(id, seq) for id, seq in records if not (manifest.get(id) == 'done' and (out_dir / f'{id}.pdb').exists())]
+    for id, _ in pending:
+        manifest[id] = 'pending'
+    save_manifest(out_dir, manifest)
+
+    shard_dir = out_dir / SHARD_DIR_NAME
+    shard_dir.mkdir(exist_ok=True)
+
+    # Worker ids are handed out so each concurrent job gets its own container name and device
+    worker_ids = queue.Queue()
+    for worker_id in range(n_workers):
+        worker_ids.put(worker_id)
+
+    def run_shard(shard_path: Path, shard: List[Tuple[str, str]]) -> List[str]:
+        worker_id = worker_ids.get()
+        try:
+            backend(shard_path, out_dir, worker_id)
+        except Exception as e:
+            print(f'Folding {shard_path.name} on worker {worker_id} failed: {e}')
+        finally:
+            worker_ids.put(worker_id)
+
+        # A shard can partly succeed, so completion is tracked per record from the files written
+        failed = [id for id, _ in shard if not (out_dir / f'{id}.pdb').exists()]
+        with manifest_lock:
+            for id, _ in shard:
+                manifest[id] = 'pending' if id in failed else 'done'
+            save_manifest(out_dir, manifest)
+        return failed
+
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        if attempt:
+            print(f'Retrying {len(pending)} records that failed to fold (retry {attempt} of {max_retries})')
+
+        batches = pack_batches(pending, max_tokens_per_batch)
+        shards = make_shards(batches, min(len(batches), n_workers * shards_per_worker))
+
+        shard_paths = [write_fasta(shard, shard_dir / f'shard_{attempt}_{i}.fasta') for i, shard in enumerate(shards)]
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            failed_ids = set()
+            for failed in executor.map(run_shard, shard_paths, shards):
+                failed_ids.update(failed)
+
+        pending = [(id, seq) for id, seq in pending if id in failed_ids]
+
+    for id, _ in pending:
+        manifest[id] = 'failed'
+    save_manifest(out_dir, manifest)
+    shutil.rmtree(shard_dir)
+
+    return manifest
+
+def docker_backend(dropout: List[float] = None, max_tokens_per_batch: int = 1300, pin_devices: bool = False) -> FoldBackend:
+    from structphy.run_inference_docker import run_esm_dropouts
+
+    # Unique container names so concurrent workers, and concurrent runs, don't collide
+    run_id = uuid.uuid4().hex[:8]
+
+    def fold(shard_fasta: Path, out_dir: Path, worker_id: int):
+        run_esm_dropouts(
+            share_dir=out_dir,
+            fasta_in=shard_fasta,
+            dropout=dropout,
+            max_tokens_per_batch=max_tokens_per_batch,
+            container_name=f'structphy-exec-{run_id}-{worker_id}',
+            device_ids=[str(worker_id)] if pin_devices else None,
+        )
+    return fold
+
+def local_backend(command: str, dropout: List[float] = None, max_tokens_per_batch: int = 1300) -> FoldBackend:
+    # command is a template, e.g. 'python esmfold_inference.py -i {fasta} -o {out_dir} --max-tokens-per-batch {max_tokens}'.
+    # {dropout} and {worker} are also filled in.
+    dropout_str = ",".join([f'{x:.4f}' for x in dropout]) if dropout else ''
+
+    # Split before filling in so paths with spaces stay one argument
+    template = shlex.split(command)
+
+    def fold(shard_fasta: Path, out_dir: Path, worker_id: int):
+        filled = [part.format(fasta=shard_fasta, out_dir=out_dir, max_tokens=max_tokens_per_batch, dropout=dropout_str, worker=worker_id) for part in template]
+        subprocess.run(filled, check=True)
+    return fold
+
+def stub_pdb_lines(id: str, seq: str) -> List[str]:
+    # Placeholder CA trace on an ideal alpha helix, with a little noise seeded by the record
+    # id so variants of one sequence differ. Only meant for testing the pipeline without a GPU.
+    three_letter = {one: three for three, one in aa_dict.items()}
+    rng = random.Random(int(hashlib.md5(id.encode()).hexdigest(), 16))
+
+    lines = [f'REMARK   1 STRUCTPHY STUB FOLD {id}\n']
+    for i, residue in enumerate(seq.upper(), start=1):
+        angle = math.radians(100 * i)
+        x = 2.3 * math.cos(angle) + rng.gauss(0, 0.2)
+        y = 2.3 * math.sin(angle) + rng.gauss(0, 0.2)
+        z = 1.5 * i + rng.gauss(0, 0.2)
+        lines.append(f'ATOM  {i:5d}  CA  {three_letter.get(residue, "UNK")} A{i:4d}    {x:8.3f}{y:8.3f}{z:8.3f}  1.00 50.00           C\n')
+    lines.append(f'TER   {len(seq) + 1:5d}      {three_letter.get(seq[-1].upper(), "UNK")} A{len(seq):4d}\n')
+    lines.append('END\n')
+    return lines
+
+def stub_backend() -> FoldBackend:
+
+    def fold(shard_fasta: Path, out_dir: Path, worker_id: int):
+        for id, seq in iter_fasta(shard_fasta):
+            with open(out_dir / f'{id}.pdb', 'w') as f:
+                f.writelines(stub_pdb_lines(id, seq))
+    return fold
+
+FOLD_BACKENDS = ['docker', 'local', 'stub']
+
+def make_backend(name: str, dropout: List[float] = None, max_tokens_per_batch: int = 1300, command: str = None, pin_devices: bool = False) -> FoldBackend:
+    if name == 'docker':
+        return docker_backend(dropout=dropout, max_tokens_per_batch=max_tokens_per_batch, pin_devices=pin_devices)
+    if name == 'local':
+        if not command:
+            raise ValueError('The local fold backend needs a command template')
+        return local_backend(command, dropout=dropout, max_tokens_per_batch=max_tokens_per_batch)
+    if name == 'stub':
+        return stub_backend()
+    raise ValueError(f'Unknown fold backend {name!r}, expected one of {", ".join(FOLD_BACKENDS)}')
@@ -1,10 +1,11 @@
 from pathlib import Path
 from typing import List
 import tempfile
-import subprocess
 import os
 from ete3 import Tree
 
+from structphy.async_executor import run_subprocesses, tool_timeout
+
 def make_command_file(command_path: Path, tree_path: Path, outgroup_position: int):
     with open(command_path, 'w') as f:
         f.write('\n')
@@ -47,16 +48,20 @@ def bootstrap_trees_to_consensus(bootstrap_trees: List[str], outgroup_name: str)
         intrees_path = temp_dir_path / 'intree'
         make_command_file(command_path, intrees_path, outgroup_position=outgroup_position)
 
-        # Have to use a shell script to get around UI of consense
-        with open(temp_dir_path / 'run.sh', 'w') as f:
-            f.write(str(CACHE_DIR / 'consense') + ' < ' + str(command_path))
-
         with open(intrees_path, 'w') as f:
             f.writelines(bootstrap_trees)
 
-        # Finally run consense 
-        consense_process = subprocess.run(['sh', temp_dir_path / 'run.sh'], cwd=str(temp_dir_path), check=True, capture_output=True, text=True)
-        consense_logs = consense_process.stdout + consense_process.stderr
+        # Finally run consense, answering its UI prompts through stdin
+        with open(command_path, 'rb') as f:
+            consense_input = f.read()
+        consense_logs = run_subprocesses(
+            [[str(CACHE_DIR / 'consense')]],
+            parse=lambda completed: completed.stdout + completed.stderr,
+            n_concurrent=1,
+            inputs=[consense_input],
+            cwd=temp_dir_path,
+            timeout=tool_timeout(),
+        )[0]
 
         with open(temp_dir_path / 'outtree', 'r') as f:
             consensus_tree = f.read().replace('\n', '').strip()
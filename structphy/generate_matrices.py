@@ -1,104 +1,210 @@
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, Tuple, Union
 import os
-import subprocess
 import re
-from multiprocessing import Pool
 import itertools
 import random
-import functools
+import collections
+import threading
 
-from tqdm.auto import tqdm
 import pandas as pd
+import numpy as np
+
+from structphy.async_executor import run_subprocesses, tool_timeout
+from structphy.deduplicate import deduplicate_structures, canonical_pair
+from structphy.distance_tensor import DistanceTensor
+from structphy.metrics import get_metric
 
 
 RMSD_re = re.compile(r"RMSD=\W+([+-]?([0-9]*[.])?[0-9]+),")
 TMscores_re = re.compile(r"TM-score=\W+([+-]?([0-9]*[.])?[0-9]+) \(")
 identical_percent_re = re.compile(r"Seq_ID=n_identical/n_aligned=\W+([+-]?([0-9]*[.])?[0-9]+)\W")
+chain_length_re = re.compile(r"Length of Chain_[12]:\W+([0-9]+) residues")
+aligned_length_re = re.compile(r"Aligned length=\W+([0-9]+),")
 
-# Wrapper for the tmalign binary
-@functools.lru_cache(maxsize=None)
-def TMalign(pdb1: Path, pdb2: Path, tmalign_path: Path):
+# Everything kept from a TMalign run, the distance metrics are derived from these later
+PAIR_RESULT_COLUMNS = ['pdb_a', 'pdb_b', 'RMSD', 'TMscore_a', 'TMscore_b', 'identical_of_aligned', 'length_a', 'length_b', 'aligned_length']
 
-  command = [str(tmalign_path), str(pdb1), str(pdb2)]
-  process = subprocess.run(command, capture_output=True, text=True)
-  output = process.stdout
+def parse_tmalign_output(output: str, pdb1: Path, pdb2: Path):
 
   RMSD = float(RMSD_re.search(output).group(1))
   TMscores = TMscores_re.findall(output)
   TMscore_a = float(TMscores[0][0])
   TMscore_b = float(TMscores[1][0])
   identical_of_aligned = float(identical_percent_re.search(output).group(1))
+  length_a, length_b = [int(length) for length in chain_length_re.findall(output)]
+  aligned_length = int(aligned_length_re.search(output).group(1))
   
   return {
       'RMSD': RMSD,
       'TMscore_a': TMscore_a,
       'TMscore_b': TMscore_b,
       'identical_of_aligned': identical_of_aligned,
+      'length_a': length_a,
+      'length_b': length_b,
+      'aligned_length': aligned_length,
+      'pdb_a': pdb1,
+      'pdb_b': pdb2
+  }
+
+def TMalign_many(structure_pairs: List[Tuple[Path, Path]], tmalign_path: Path, n_threads: int, timeout: float = None, retries: int = 1) -> List[dict]:
+
+  # TMalign is I/O bound from our side, so children are driven from one event loop
+  # rather than a Python worker process per core
+  commands = [[str(tmalign_path), str(pdb1), str(pdb2)] for pdb1, pdb2 in structure_pairs]
+  return run_subprocesses(
+      commands,
+      parse=lambda completed: parse_tmalign_output(completed.stdout, Path(completed.args[1]), Path(completed.args[2])),
+      n_concurrent=n_threads,
+      timeout=timeout,
+      retries=retries,
+      desc='Aligning pairs',
+      leave=False,
+  )
+
+def count_residues(pdb_file: Path) -> int:
+  with open(pdb_file) as f:
+    return len(set(line[21:27] for line in f if line.startswith('ATOM')))
+
+def identical_tmalign_result(pdb1: Path, pdb2: Path):
+  # What TMalign reports for two structures with the same coordinates
+  length = count_residues(pdb1)
+  return {
+      'RMSD': 0.0,
+      'TMscore_a': 1.0,
+      'TMscore_b': 1.0,
+      'identical_of_aligned': 1.0,
+      'length_a': length,
+      'length_b': length,
+      'aligned_length': length,
       'pdb_a': pdb1,
       'pdb_b': pdb2
   }
 
-# Wrapper required for multiprocessing
-def tmalign_wrapper(args): 
-   return TMalign(args[0], args[1], args[2])
+def relabel_tmalign_result(tm_result: dict, pdb1: Path, pdb2: Path, swapped: bool):
+  relabelled = dict(tm_result, pdb_a=pdb1, pdb_b=pdb2)
+  if swapped:
+    relabelled['TMscore_a'], relabelled['TMscore_b'] = tm_result['TMscore_b'], tm_result['TMscore_a']
+    relabelled['length_a'], relabelled['length_b'] = tm_result['length_b'], tm_result['length_a']
+  return relabelled
+
+# Alignments keyed by the canonical pair of structure fingerprints, so a structure that turns
+# up again under another path, e.g. in a later service job, is never aligned twice. Least
+# recently used alignments are dropped past TMALIGN_CACHE_SIZE to bound a long lived process.
+TMALIGN_CACHE_SIZE = 100_000
+_tmalign_results = collections.OrderedDict()
+_tmalign_results_lock = threading.Lock()
 
-def generate_matrix_from_bootstraps(structure_files: List[Path], n_threads: int) -> pd.DataFrame:
+def cached_tmalign_result(key: Tuple[str, str]):
+    with _tmalign_results_lock:
+        tm_result = _tmalign_results.get(key)
+        if tm_result is not None:
+            _tmalign_results.move_to_end(key)
+        return tm_result
+
+def cache_tmalign_result(key: Tuple[str, str], tm_result: dict):
+    with _tmalign_results_lock:
+        _tmalign_results[key] = tm_result
+        _tmalign_results.move_to_end(key)
+        while len(_tmalign_results) > TMALIGN_CACHE_SIZE:
+            _tmalign_results.popitem(last=False)
+
+def align_structure_pairs(structure_pairs: List[Tuple[Path, Path]], n_threads: int, representatives: Dict[Path, Path] = None, fingerprints: Dict[Path, str] = None) -> Tuple[Dict[Tuple[Path, Path], dict], Dict[str, int]]:
     CACHE_DIR = Path(os.environ["STRUCTPHY_CACHE_DIR"])
 
-    # Get all combinations of structures, and add the TMalign binary location to the argument
-    all_structure_combinations  = list(itertools.combinations(structure_files, r=2))
-    all_structure_combinations = [tuple(list(x) + [CACHE_DIR / 'TMalign']) for x in all_structure_combinations]
-
-    # Run all tmaligns multithreaded
-    tm_results = []
-    with Pool(n_threads) as pool:
-        for tm_result in tqdm(
-            pool.imap_unordered(tmalign_wrapper, all_structure_combinations),
-            total=len(all_structure_combinations),
-            leave=False,
-            desc='Current bootstrap',
-            ascii=True,
-            ):
-            tm_results.append(tm_result)
-    
-    # Take the maximum score between two proteins as the re
-    tm_scores = [{
-        'max_score': max(tm_result['TMscore_a'], tm_result['TMscore_b']),
-        'pdb_a': tm_result['pdb_a'].name.split('.')[0],
-        'pdb_b': tm_result['pdb_b'].name.split('.')[0],
-        } for tm_result in tm_results]
-    
-    # Load scores into a dataframe with columns ['pdb_a', 'pdb_b', 'max_score']
-    tm_df = pd.DataFrame.from_records(tm_scores)
-
-    # Make a copy with pdb_a and pdb_b swapped to fill out both triangles of the matrix
-    tm_copy = tm_df.copy()
-    a_col = tm_copy['pdb_a'].copy()
-    tm_copy['pdb_a'] = tm_copy['pdb_b']
-    tm_copy['pdb_b'] = a_col
-    tm_copy = tm_copy[tm_copy['pdb_a'] != tm_copy['pdb_b']]
-    tm_mix = pd.concat([tm_df, tm_copy])
-
-    # Pivot and sort the score records to produce the square similarity matrix
-    similarity_matrix = tm_mix.pivot_table(columns='pdb_b', index='pdb_a', values='max_score')
-    similarity_matrix = similarity_matrix.reindex(sorted(similarity_matrix.columns), axis=1)
-    similarity_matrix = similarity_matrix.sort_index()
-    similarity_matrix.index.name = None
-    similarity_matrix.columns.name = None
-
-    # Make sure all entries are filled
-    # nan_indices = np.where(pd.isnull(piv))
-    # assert (nan_indices[0] == nan_indices[1]).all(), 'NaNs found outside the diagonal'
+    if representatives is None or fingerprints is None:
+        representatives, _, fingerprints = deduplicate_structures(set(itertools.chain.from_iterable(structure_pairs)))
+
+    # Work out which alignments are actually new. Results this call needs are held on to
+    # here, other jobs filling the cache can't evict them before they are used.
+    requested_pairs = list(dict.fromkeys(structure_pairs))
+    known = {}
+    to_align = {}
+    n_identical = 0
+    n_cached = 0
+    for pdb1, pdb2 in requested_pairs:
+        if fingerprints[pdb1] == fingerprints[pdb2]:
+            n_identical += 1
+            continue
+        key, swapped = canonical_pair(fingerprints[pdb1], fingerprints[pdb2])
+        if key in known or key in to_align:
+            continue
+        tm_result = cached_tmalign_result(key)
+        if tm_result is not None:
+            known[key] = tm_result
+            n_cached += 1
+        else:
+            rep1, rep2 = representatives[pdb1], representatives[pdb2]
+            to_align[key] = (rep2, rep1) if swapped else (rep1, rep2)
+
+    tm_results = TMalign_many(list(to_align.values()), CACHE_DIR / 'TMalign', n_threads=n_threads, timeout=tool_timeout())
+    for key, tm_result in zip(to_align, tm_results):
+        known[key] = tm_result
+        cache_tmalign_result(key, tm_result)
+
+    # Hand every requested pair its result, labelled with the structures that were asked for
+    pair_results = {}
+    for pdb1, pdb2 in requested_pairs:
+        if fingerprints[pdb1] == fingerprints[pdb2]:
+            pair_results[(pdb1, pdb2)] = identical_tmalign_result(pdb1, pdb2)
+        else:
+            key, swapped = canonical_pair(fingerprints[pdb1], fingerprints[pdb2])
+            pair_results[(pdb1, pdb2)] = relabel_tmalign_result(known[key], pdb1, pdb2, swapped)
+
+    stats = {
+        'requested': len(structure_pairs),
+        'distinct_requested': len(requested_pairs),
+        'identical': n_identical,
+        'cached': n_cached,
+        'aligned': len(to_align),
+    }
+    return pair_results, stats
+
+def structure_name(pdb_file: Path) -> str:
+    return pdb_file.name.split('.')[0]
+
+def pair_results_to_dataframe(tm_results: List[dict]) -> pd.DataFrame:
+    # One row per aligned pair, structures referred to by name (e.g. 'ARAF#0')
+    pair_df = pd.DataFrame.from_records(tm_results, columns=PAIR_RESULT_COLUMNS)
+    pair_df['pdb_a'] = pair_df['pdb_a'].map(structure_name)
+    pair_df['pdb_b'] = pair_df['pdb_b'].map(structure_name)
+    return pair_df
+
+def symmetric_distances(pair_df: pd.DataFrame, metric: Union[str, Callable] = 'tm_max') -> pd.Series:
+    # Distances indexed by (name_a, name_b) in both orientations
+    distances = np.asarray(get_metric(metric)(pair_df), dtype=float)
+    forward = pd.Series(distances, index=pd.MultiIndex.from_arrays([pair_df['pdb_a'], pair_df['pdb_b']]))
+    backward = pd.Series(distances, index=pd.MultiIndex.from_arrays([pair_df['pdb_b'], pair_df['pdb_a']]))
+    both = pd.concat([forward, backward])
+    return both[~both.index.duplicated()]
+
+def distance_matrix_from_distances(distances: pd.Series, structure_names: List[str]) -> pd.DataFrame:
     
-    # 1-similarity = distance
-    # Convert similarity given by tmalign to a distance
+    # Look up every cell of the sorted square matrix at once
+    structure_names = sorted(structure_names)
+    n = len(structure_names)
+    cells = pd.MultiIndex.from_product([structure_names, structure_names])
+    values = distances.reindex(cells).to_numpy(dtype=float, copy=True).reshape(n, n)
+
     # Fill diagonal with 0s for self similarity
-    distance_matrix = 1-similarity_matrix
-    distance_matrix = distance_matrix.fillna(0)
-    return distance_matrix
+    values[np.isnan(values)] = 0
+    return pd.DataFrame(values, index=structure_names, columns=structure_names)
+
+def distance_matrix_from_tm_results(tm_results: List[dict], metric: Union[str, Callable] = 'tm_max') -> pd.DataFrame:
+    pair_df = pair_results_to_dataframe(tm_results)
+    structure_names = set(pair_df['pdb_a']) | set(pair_df['pdb_b'])
+    return distance_matrix_from_distances(symmetric_distances(pair_df, metric), structure_names)
+
+def generate_matrix_from_bootstraps(structure_files: List[Path], n_threads: int, metric: Union[str, Callable] = 'tm_max') -> pd.DataFrame:
+
+    # Get all combinations of structures and align the ones not seen before
+    all_structure_combinations  = list(itertools.combinations(structure_files, r=2))
+    pair_results, _ = align_structure_pairs(all_structure_combinations, n_threads=n_threads)
+    return distance_matrix_from_tm_results([pair_results[pair] for pair in all_structure_combinations], metric=metric)
 
-def generate_bootstrap_matrices_from_structures(structure_files: List[Path], n_threads: int, n_bootstraps:int) -> List[pd.DataFrame]:
+def align_bootstrap_structures(structure_files: List[Path], n_threads: int, n_bootstraps: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # Returns the stored pair results and the structures sampled for each bootstrap,
+    # which together are enough to build the bootstrap matrices for any metric.
 
     # Set up ids_dict to sample a set of bootstrap structures for each matrix
     # Of form {id: [Path(id#0), Path(id#1), ...], ...}
@@ -107,13 +213,67 @@ def generate_bootstrap_matrices_from_structures(structure_files: List[Path], n_t
     for path in structure_files:
         ids_dict[path.name.split('#')[0]].append(path)
     
-    # Run the matrices
-    bootstrap_matrices = []
-    for i in tqdm(range(n_bootstraps), desc='Total bootstraps ', ascii=True, position=0):
-        bootstrap_structures = [random.sample(bootstraps, 1)[0] for id, bootstraps in ids_dict.items()]
-        bootstrap_matrices.append(generate_matrix_from_bootstraps(bootstrap_structures, n_threads=n_threads))
-    
-    return bootstrap_matrices
+    # Sample every bootstrap up front so the alignment work can be planned as a whole.
+    # Each bootstrap holds one variant per protein, so pairs of a protein's own variants are never requested.
+    bootstrap_samples = [[random.sample(bootstraps, 1)[0] for id, bootstraps in ids_dict.items()] for i in range(n_bootstraps)]
+    bootstrap_pairs = [list(itertools.combinations(bootstrap_structures, r=2)) for bootstrap_structures in bootstrap_samples]
+
+    # Collapse byte-identical or coordinate-identical structures before aligning anything
+    representatives, multiplicity, fingerprints = deduplicate_structures(structure_files)
+    pair_results, stats = align_structure_pairs(
+        list(itertools.chain.from_iterable(bootstrap_pairs)),
+        n_threads=n_threads,
+        representatives=representatives,
+        fingerprints=fingerprints,
+    )
+
+    n_duplicates = sum(count - 1 for count in multiplicity.values())
+    print(f'Structures: {len(structure_files)} ({len(multiplicity)} distinct, {n_duplicates} duplicates collapsed)')
+    print(f'Pair alignments: {stats["requested"]} requested by {n_bootstraps} bootstraps, '
+          f'{stats["distinct_requested"]} distinct, {stats["identical"]} between identical structures, '
+          f'{stats["cached"]} already aligned, {stats["aligned"]} run '
+          f'({100 * (1 - stats["aligned"] / max(stats["requested"], 1)):.1f}% saved)')
+
+    pair_df = pair_results_to_dataframe(list(pair_results.values()))
+    samples_df = pd.DataFrame(
+        [{id: structure_name(path) for id, path in zip(ids_dict, bootstrap_structures)} for bootstrap_structures in bootstrap_samples],
+        columns=sorted(ids_dict),
+    )
+    return pair_df, samples_df
+
+def bootstrap_matrices_from_pair_results(pair_df: pd.DataFrame, samples_df: pd.DataFrame, metric: Union[str, Callable] = 'tm_max') -> List[pd.DataFrame]:
+    # No alignment happens here, so switching metric only costs a few lookups per bootstrap
+    distances = symmetric_distances(pair_df, metric)
+    return [distance_matrix_from_distances(distances, list(sample.values)) for _, sample in samples_df.iterrows()]
+
+def bootstrap_tensor_from_pair_results(pair_df: pd.DataFrame, samples_df: pd.DataFrame, metric: Union[str, Callable] = 'tm_max') -> DistanceTensor:
+    # Same matrices as bootstrap_matrices_from_pair_results, written straight into one stacked array.
+    # Rows and columns follow the sorted protein ids, not the sampled structure names.
+    distances = symmetric_distances(pair_df, metric)
+    taxa = sorted(samples_df.columns)
+    labels = [[str(name) for name in sample] for sample in samples_df[taxa].itertuples(index=False)]
+    tensor = DistanceTensor.create(len(samples_df), taxa, labels=labels)
+    for i, names in enumerate(labels):
+        cells = pd.MultiIndex.from_product([names, names])
+        values = distances.reindex(cells).to_numpy(dtype=float, copy=True).reshape(len(names), len(names))
+        # Self distances are missing from the pair results
+        values[np.isnan(values)] = 0
+        tensor.values[i] = values
+    return tensor
+
+def generate_bootstrap_matrices_from_structures(structure_files: List[Path], n_threads: int, n_bootstraps:int, metric: Union[str, Callable] = 'tm_max') -> List[pd.DataFrame]:
+    pair_df, samples_df = align_bootstrap_structures(structure_files, n_threads=n_threads, n_bootstraps=n_bootstraps)
+    return bootstrap_matrices_from_pair_results(pair_df, samples_df, metric=metric)
+
+def save_pair_results(pair_df: pd.DataFrame, samples_df: pd.DataFrame, pair_dir: Path):
+    pair_dir.mkdir(parents=True, exist_ok=True)
+    pair_df.to_csv(pair_dir / 'pair_results.csv', index=False, float_format='%.8G')
+    samples_df.to_csv(pair_dir / 'bootstrap_samples.csv', index_label='bootstrap')
+
+def load_pair_results(pair_dir: Path) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    pair_df = pd.read_csv(pair_dir / 'pair_results.csv')
+    samples_df = pd.read_csv(pair_dir / 'bootstrap_samples.csv', index_col='bootstrap')
+    return pair_df, samples_df
 
 def make_fake_outgroups(distance_matrices: List[pd.DataFrame], fake_outgroup: str) -> List[pd.DataFrame]:
     
@@ -121,7 +281,7 @@ def make_fake_outgroups(distance_matrices: List[pd.DataFrame], fake_outgroup: st
     for distance_matrix in distance_matrices:
         distance_matrix[fake_outgroup] = 1_000_000.0
         distance_matrix.loc[fake_outgroup] = 1_000_000.0
-        distance_matrix[fake_outgroup].loc[fake_outgroup] = 0.0
+        distance_matrix.loc[fake_outgroup, fake_outgroup] = 0.0
         faked_distance_matrices.append(distance_matrix)
 
     return faked_distance_matrices
\ No newline at end of file
@@ -1,24 +1,33 @@
-from typing import List
+from pathlib import Path
+from typing import Callable, Dict, List, Union
+import os
+import numpy as np
 import pandas as pd
 import subprocess
-from tqdm.auto import tqdm
-from multiprocessing import Pool
 
+from structphy.async_executor import run_subprocesses, tool_timeout
+from structphy.distance_tensor import DistanceTensor, tensor_from_dataframes
+from structphy.generate_matrices import bootstrap_tensor_from_pair_results
 
-def fastme(phylip_matrix: str) -> str:
+
+# Tree building methods accepted by --method, as fastme -m spells them
+FASTME_METHODS = ['NJ', 'BioNJ', 'UNJ', 'TaxAdd_BalME', 'TaxAdd_OLSME']
+
+def fastme_command(method: str = 'NJ') -> List[str]:
     # TODO This is a total hack, using stderr as an alternative pipe
     # Works fine if the command never fails :)
-    command = ['./.structphy/fastme', '-i', '/dev/stdin', '-I', '/dev/null', '-O', '/dev/null', '-o', '/dev/stderr', '-s', '-m', 'NJ']
-    result = subprocess.run(command, input=phylip_matrix.encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    CACHE_DIR = Path(os.environ["STRUCTPHY_CACHE_DIR"])
+    return [str(CACHE_DIR / 'fastme'), '-i', '/dev/stdin', '-I', '/dev/null', '-O', '/dev/null', '-o', '/dev/stderr', '-s', '-m', method]
 
-    newick = result.stderr.decode().strip()
-    return newick
+def fastme(phylip_matrix: str, method: str = 'NJ') -> str:
+    command = fastme_command(method)
+    result = subprocess.run(command, input=phylip_matrix.encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, timeout=tool_timeout())
+    return parse_fastme_newick(subprocess.CompletedProcess(command, result.returncode, result.stdout.decode(), result.stderr.decode()))
 
 def convert_matrix_to_phylip(distance_df: pd.DataFrame) -> str: 
 
     split_bootstrap_id = lambda x: x.split('#')[0]
-    distance_df.index = distance_df.index.map(split_bootstrap_id)
-    distance_df.columns = distance_df.columns.map(split_bootstrap_id)
+    distance_df = distance_df.rename(index=split_bootstrap_id, columns=split_bootstrap_id)
 
     phylip_out = ""
     phylip_out += (str(len(distance_df))+'\n')
@@ -27,22 +36,69 @@ def convert_matrix_to_phylip(distance_df: pd.DataFrame) -> str:
 
     return phylip_out
 
-# Wrapper required for multiprocessing
-def matrix_to_fastme_newick(distance_df: pd.DataFrame) -> str:
+def matrix_to_fastme_newick(distance_df: pd.DataFrame, method: str = 'NJ') -> str:
     phylip_matrix = convert_matrix_to_phylip(distance_df)
-    fastme_newick = fastme(phylip_matrix)
+    fastme_newick = fastme(phylip_matrix, method=method)
     return fastme_newick
 
-def matrices_to_fastme_newick(distance_dfs: List[pd.DataFrame], n_threads: int) -> List[str]:
-    
-    fastme_trees = []
-    with Pool(n_threads) as pool:
-        for fastme_result in tqdm(
-            pool.imap_unordered(matrix_to_fastme_newick, distance_dfs),
-            total=len(distance_dfs),
-            desc='Building trees',
-            ascii=True,
-            ):
-            fastme_trees.append(fastme_result)
-    
-    return fastme_trees
\ No newline at end of file
+def phylip_from_array(taxa: List[str], distances: np.ndarray, outgroup_name: str = None) -> str:
+    # The fake outgroup is added here, far from everything, so the stored matrices never need copying
+    if outgroup_name:
+        n = len(taxa)
+        padded = np.full((n + 1, n + 1), 1_000_000.0)
+        padded[:n, :n] = distances
+        padded[n, n] = 0.0
+        taxa, distances = list(taxa) + [outgroup_name], padded
+
+    lines = [str(len(taxa))]
+    for name, row in zip(taxa, distances):
+        lines.append(name+" "+" ".join(f'{x:.8f}' for x in row))
+    return '\n'.join(lines)+'\n'
+
+class PhylipMatrices:
+    # Phylip text for each bootstrap of a tensor, formatted from its view only when
+    # fastme is about to read it, so just the matrices being worked on are held as text
+
+    def __init__(self, tensor: DistanceTensor, outgroup_name: str = None):
+        self.tensor = tensor
+        self.outgroup_name = outgroup_name
+
+    def __len__(self):
+        return len(self.tensor)
+
+    def __getitem__(self, i: int) -> bytes:
+        return phylip_from_array(self.tensor.taxa, self.tensor.values[i], self.outgroup_name).encode()
+
+def parse_fastme_newick(completed: subprocess.CompletedProcess) -> str:
+    # The tree comes back on stderr, so anything else fastme writes there would pass for one
+    newick = completed.stderr.strip()
+    if not newick.endswith(';'):
+        raise ValueError(f'fastme did not write a newick tree: {newick[:200]!r}')
+    return newick
+
+def tensor_to_fastme_newick(tensor: DistanceTensor, n_threads: int, method: str = 'NJ', outgroup_name: str = None) -> List[str]:
+    # Matrices are fed to fastme over stdin from the event loop, with the same timeout
+    # and exit code checks as the other tools
+    phylip_matrices = PhylipMatrices(tensor, outgroup_name)
+    command = fastme_command(method)
+    return run_subprocesses(
+        [command] * len(phylip_matrices),
+        parse=parse_fastme_newick,
+        n_concurrent=n_threads,
+        inputs=phylip_matrices,
+        timeout=tool_timeout(),
+        desc='Building trees',
+    )
+
+def matrices_to_fastme_newick(distance_dfs: List[pd.DataFrame], n_threads: int, method: str = 'NJ') -> List[str]:
+    with tensor_from_dataframes(distance_dfs) as tensor:
+        return tensor_to_fastme_newick(tensor, n_threads=n_threads, method=method)
+
+def pair_results_to_fastme_newick(pair_df: pd.DataFrame, samples_df: pd.DataFrame, metrics: List[Union[str, Callable]], n_threads: int, outgroup_name: str = '!_OUTGROUP_!', method: str = 'NJ') -> Dict[Union[str, Callable], List[str]]:
+    # Bootstrap trees for several distance metrics from one set of stored alignments
+    metric_trees = {}
+    for metric in metrics:
+        with bootstrap_tensor_from_pair_results(pair_df, samples_df, metric=metric) as tensor:
+            metric_trees[metric] = tensor_to_fastme_newick(tensor, n_threads=n_threads, method=method, outgroup_name=outgroup_name)
+
+    return metric_trees
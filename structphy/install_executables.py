@@ -1,14 +1,83 @@
-import requests
 import subprocess
 from sys import platform
 from pathlib import Path
+from typing import Callable, List
+import hashlib
+import json
 import os
 import tarfile
+import tempfile
 import shutil
 
-def install_tmalign(CACHE_DIR, TMALIGN_URL):
+# Sources are kept here once fetched so tools can be rebuilt, with other flags, without the network
+SOURCES_DIR_NAME = 'sources'
+# Built variants, keyed by tool, source, compiler and flags
+BUILDS_DIR_NAME = 'builds'
 
-    # Define the download location for TMAlign source code.
+# What install_tmalign has always compiled with
+TMALIGN_FLAGS = ['-O3', '-ffast-math']
+# Autoconf's default optimisation, which a stock FastME configure uses
+FASTME_FLAGS = ['-O2']
+
+# Extra flags for each variant and whether it is trained with profile guided optimisation
+BUILD_VARIANTS = {
+    'baseline': ([], False),
+    'native': (['-march=native'], False),
+    'lto': (['-flto'], False),
+    'native-lto': (['-march=native', '-flto'], False),
+    'pgo': ([], True),
+    'native-lto-pgo': (['-march=native', '-flto'], True),
+}
+
+def fetch_source(CACHE_DIR: Path, URL: str, source: Path = None) -> Path:
+    # A local copy (vendored, or downloaded elsewhere) is used instead of the URL when given,
+    # otherwise the cached copy, and only then is the source downloaded
+    sources_dir = CACHE_DIR / SOURCES_DIR_NAME
+    sources_dir.mkdir(exist_ok=True)
+    cached = sources_dir / os.path.basename(URL)
+
+    if source is not None:
+        if Path(source).resolve() != cached.resolve():
+            shutil.copy(source, cached)
+    elif not cached.exists():
+        import requests
+        response = requests.get(URL)
+        response.raise_for_status()
+        with open(cached, 'wb') as file:
+            file.write(response.content)
+
+    return cached
+
+def prepare_tmalign_source(source_cpp: Path, out_cpp: Path):
+    with open(source_cpp, encoding='utf-8') as file:
+        mac_fix = file.read()
+    # Mac doesnt have malloc.h apparently. We can get it from stdlib.h
+    # Got this fix from here: https://github.com/RIOT-OS/RIOT/issues/2361
+    if platform == "darwin":
+        mac_fix = mac_fix.replace("#include <malloc.h>", 
+            """
+            #if defined(__MACH__)
+            #include <stdlib.h>
+            #else 
+            #include <malloc.h>
+            #endif
+            """
+        )
+    with open(out_cpp, 'w') as file:
+        file.write(mac_fix)
+
+def compile_tmalign(TMalign_cpp_filename: Path, executable: Path, flags: List[str] = TMALIGN_FLAGS) -> str:
+    # On Mac don't compile with '-static' argument.
+    static = ['-static'] if platform != "darwin" else []
+    command = ['g++'] + static + flags + ['-o', str(executable), str(TMalign_cpp_filename), '-lm']
+    completed_process = subprocess.run(command, check=True, capture_output=True, text=True)
+    compile_logs = completed_process.stdout + completed_process.stderr
+    os.chmod(executable, 0o777)
+    return compile_logs
+
+def install_tmalign(CACHE_DIR, TMALIGN_URL, source: Path = None):
+
+    # Define the location for the TMAlign source code.
     # Then remove that directory if it already exists.
     TMalign_dir = CACHE_DIR / 'TMalign_src'
     TMalign_cpp_filename = TMalign_dir / 'TMalign.cpp'
@@ -18,45 +87,20 @@ def install_tmalign(CACHE_DIR, TMALIGN_URL):
         pass
     TMalign_dir.mkdir(parents=False, exist_ok=True)
 
-    # Download the source code
-    response = requests.get(TMALIGN_URL)
-    response.raise_for_status()
-    
-    with open(TMalign_cpp_filename, 'w') as file:
-        mac_fix = response.content.decode('utf-8')
-        # Mac doesnt have malloc.h apparently. We can get it from stdlib.h
-        # Got this fix from here: https://github.com/RIOT-OS/RIOT/issues/2361
-        if platform == "darwin":
-            mac_fix = mac_fix.replace("#include <malloc.h>", 
-                """
-                #if defined(__MACH__)
-                #include <stdlib.h>
-                #else 
-                #include <malloc.h>
-                #endif
-                """
-            )
-        file.write(mac_fix)
+    # Fetch the source code, from the sources cache when it has been fetched before
+    prepare_tmalign_source(fetch_source(CACHE_DIR, TMALIGN_URL, source), TMalign_cpp_filename)
 
     # Compile TMalign.cpp and make sure its executable
-    # On Mac don't compile with '-static' argument.
-    executable = str(CACHE_DIR / 'TMalign')
-    command = ['g++', '-static' if platform != "darwin" else "", '-O3', '-ffast-math', '-lm', '-o', executable, str(TMalign_cpp_filename)]
-    completed_process = subprocess.run(command, check=True, capture_output=True, text=True)
-    compile_logs = completed_process.stdout + completed_process.stderr
-    os.chmod(executable, 0o777)
+    compile_tmalign(TMalign_cpp_filename, CACHE_DIR / 'TMalign')
 
-def download_extract_tar(CACHE_DIR: Path, tar_location: Path, extract_location: Path, URL: str):
+def download_extract_tar(CACHE_DIR: Path, tar_location: Path, extract_location: Path, URL: str, source: Path = None):
     try:
         shutil.rmtree(extract_location)
     except FileNotFoundError:
         pass
     
-    # Download the fastme tarball
-    response = requests.get(URL)
-    response.raise_for_status()
-    with open(tar_location, 'wb') as file:
-        file.write(response.content)
+    # Fetch the tarball, from the sources cache when it has been fetched before
+    shutil.copy(fetch_source(CACHE_DIR, URL, source), tar_location)
 
     # Extract the tarball
     with tarfile.open(tar_location, 'r:gz') as tar:
@@ -64,13 +108,14 @@ def download_extract_tar(CACHE_DIR: Path, tar_location: Path, extract_location:
         tar.extractall(path=CACHE_DIR)
     (CACHE_DIR / extracted_dir).rename(extract_location)
 
-def install_fastme(CACHE_DIR, FASTME_URL):
+def install_fastme(CACHE_DIR, FASTME_URL, source: Path = None):
 
     download_extract_tar(
         CACHE_DIR = CACHE_DIR,
         tar_location = CACHE_DIR / os.path.basename(FASTME_URL), 
         extract_location = CACHE_DIR / 'FastME-master',
-        URL = FASTME_URL
+        URL = FASTME_URL,
+        source = source,
     )    
 
     # Run the configure script to generate the makefile
@@ -85,17 +130,90 @@ def install_fastme(CACHE_DIR, FASTME_URL):
     subprocess.run(['cp', str(CACHE_DIR / 'FastME-master' / 'src' / 'fastme'), str(CACHE_DIR / 'fastme')], check=True)
     os.chmod(str(CACHE_DIR / 'fastme'), 0o777)
 
-def install_consense(CACHE_DIR, CONSENSE_URL):
+def install_consense(CACHE_DIR, CONSENSE_URL, source: Path = None):
     
     download_extract_tar(
         CACHE_DIR = CACHE_DIR,
         tar_location = CACHE_DIR / os.path.basename(CONSENSE_URL), 
         extract_location = CACHE_DIR / 'phylip-master',
-        URL = CONSENSE_URL
+        URL = CONSENSE_URL,
+        source = source,
     )    
 
     make_process = subprocess.run(['make', '-f', 'Makefile.osx', 'consense'], cwd=str(CACHE_DIR / 'phylip-master' / 'src'), check=True, capture_output=True, text=True)
     make_logs = make_process.stdout + make_process.stderr
 
     subprocess.run(['cp', str(CACHE_DIR / 'phylip-master' / 'src' / 'consense'), str(CACHE_DIR / 'consense')], check=True)
-    os.chmod(str(CACHE_DIR / 'consense'), 0o777)
\ No newline at end of file
+    os.chmod(str(CACHE_DIR / 'consense'), 0o777)
+
+def compiler_version() -> str:
+    completed_process = subprocess.run(['g++', '--version'], check=True, capture_output=True, text=True)
+    return completed_process.stdout.splitlines()[0]
+
+def build_key(tool: str, source: Path, flags: List[str], pgo: bool, training: str = '') -> str:
+    # Anything that changes the binary changes the key, so a cached build is never stale
+    digest = hashlib.blake2b(digest_size=8)
+    with open(source, 'rb') as file:
+        digest.update(file.read())
+    digest.update(json.dumps([tool, compiler_version(), flags, pgo, training if pgo else '']).encode())
+    return digest.hexdigest()
+
+def compile_fastme(source_tar: Path, build_dir: Path, flags: List[str]) -> Path:
+    # Builds in build_dir/src so a profile guided rebuild finds its profile under the same paths
+    source_dir = build_dir / 'src'
+    if not source_dir.exists():
+        with tarfile.open(source_tar, 'r:gz') as tar:
+            extracted_dir = tar.getnames()[0]
+            tar.extractall(path=build_dir)
+        (build_dir / extracted_dir).rename(source_dir)
+    else:
+        subprocess.run(['make', 'clean'], cwd=str(source_dir), check=True, capture_output=True, text=True)
+
+    subprocess.run(['./configure', f'CFLAGS={" ".join(flags)}', f'LDFLAGS={" ".join(flags)}'], cwd=str(source_dir), check=True, capture_output=True, text=True)
+    subprocess.run(['make'], cwd=str(source_dir), check=True, capture_output=True, text=True)
+    return source_dir / 'src' / 'fastme'
+
+def build_variant(
+        CACHE_DIR: Path,
+        tool: str,
+        source: Path,
+        variant: str,
+        train: Callable[[Path], None] = None,
+        training: str = '',
+    ) -> Path:
+    # Builds one of BUILD_VARIANTS of 'TMalign' or 'fastme' into .structphy/builds, or returns the cached build.
+    # Profile guided variants are built instrumented, run through train(executable), then rebuilt with the profile.
+    extra_flags, pgo = BUILD_VARIANTS[variant]
+    flags = (TMALIGN_FLAGS if tool == 'TMalign' else FASTME_FLAGS) + extra_flags
+    if pgo and train is None:
+        raise ValueError(f'Variant {variant} needs a training run')
+
+    builds_dir = CACHE_DIR / BUILDS_DIR_NAME
+    builds_dir.mkdir(exist_ok=True)
+    executable = builds_dir / f'{tool}-{variant}-{build_key(tool, source, flags, pgo, training)}'
+    if executable.exists():
+        return executable
+
+    with tempfile.TemporaryDirectory(dir=builds_dir) as build_dir:
+        build_dir = Path(build_dir)
+        profile_dir = build_dir / 'profile'
+
+        def compile(stage_flags: List[str]) -> Path:
+            if tool == 'TMalign':
+                prepare_tmalign_source(source, build_dir / 'TMalign.cpp')
+                compile_tmalign(build_dir / 'TMalign.cpp', build_dir / 'TMalign', stage_flags)
+                return build_dir / 'TMalign'
+            return compile_fastme(source, build_dir, stage_flags)
+
+        if pgo:
+            train(compile(flags + [f'-fprofile-generate={profile_dir}']))
+            built = compile(flags + [f'-fprofile-use={profile_dir}', '-fprofile-correction'])
+        else:
+            built = compile(flags)
+
+        # Copied under a temporary name first so a half written build is never picked up
+        shutil.copy(built, executable.with_suffix('.tmp'))
+        os.chmod(executable.with_suffix('.tmp'), 0o777)
+        executable.with_suffix('.tmp').rename(executable)
+
+    return executable
@@ -0,0 +1,54 @@
+from typing import Callable, Union
+import numpy as np
+import pandas as pd
+
+
+# Each metric turns the stored pair results (one row per aligned pair, see
+# generate_matrices.pair_results_to_dataframe) into a distance per row.
+# Metrics must be symmetric in a and b since the matrices are mirrored from one triangle.
+
+def tm_max(pairs: pd.DataFrame) -> pd.Series:
+    # The original structphy distance, 1 - the larger of the two normalised TM-scores
+    return 1 - np.maximum(pairs['TMscore_a'], pairs['TMscore_b'])
+
+def tm_min(pairs: pd.DataFrame) -> pd.Series:
+    return 1 - np.minimum(pairs['TMscore_a'], pairs['TMscore_b'])
+
+def tm_mean(pairs: pd.DataFrame) -> pd.Series:
+    return 1 - (pairs['TMscore_a'] + pairs['TMscore_b']) / 2
+
+def tm_longer(pairs: pd.DataFrame) -> pd.Series:
+    # TM-score normalised by the length of the longer chain
+    return 1 - np.where(pairs['length_a'] >= pairs['length_b'], pairs['TMscore_a'], pairs['TMscore_b'])
+
+def tm_shorter(pairs: pd.DataFrame) -> pd.Series:
+    # TM-score normalised by the length of the shorter chain
+    return 1 - np.where(pairs['length_a'] < pairs['length_b'], pairs['TMscore_a'], pairs['TMscore_b'])
+
+def rmsd(pairs: pd.DataFrame) -> pd.Series:
+    return pairs['RMSD']
+
+def seq_id(pairs: pd.DataFrame) -> pd.Series:
+    return 1 - pairs['identical_of_aligned']
+
+def tm_seq_id(pairs: pd.DataFrame) -> pd.Series:
+    # Combined structure and sequence distance, the mean of tm_max and seq_id
+    return (tm_max(pairs) + seq_id(pairs)) / 2
+
+METRICS = {
+    'tm_max': tm_max,
+    'tm_min': tm_min,
+    'tm_mean': tm_mean,
+    'tm_longer': tm_longer,
+    'tm_shorter': tm_shorter,
+    'rmsd': rmsd,
+    'seq_id': seq_id,
+    'tm_seq_id': tm_seq_id,
+}
+
+def get_metric(metric: Union[str, Callable[[pd.DataFrame], pd.Series]]) -> Callable[[pd.DataFrame], pd.Series]:
+    if callable(metric):
+        return metric
+    if metric not in METRICS:
+        raise ValueError(f'Unknown metric {metric!r}, expected one of {", ".join(METRICS)}')
+    return METRICS[metric]
@@ -0,0 +1,180 @@
+from pathlib import Path
+from typing import Dict, List
+import os
+
+# Stages shared by the single run CLI and the sweep. Heavy modules are imported inside
+# each stage, same as in __main__, so importing this module stays cheap.
+
+FAKE_OUTGROUP_NAME = '!_OUTGROUP_!'
+
+
+def fold_fasta(
+        fasta_dict_no_gaps: Dict[str, str],
+        fold_dir: Path,
+        n_variants: int,
+        dropout: List[float] = None,
+        backend: str = 'docker',
+        n_workers: int = 1,
+        max_tokens_per_batch: int = 1300,
+        fold_command: str = None,
+    ) -> Path:
+    from structphy.fasta_loading import iter_bootstrap_records
+    from structphy.fold_scheduler import make_backend, schedule_folds
+
+    if backend == 'docker':
+        print('Pulling and folding using docker image \'finnod/structphy-esmdropouts-openfold\'')
+    fold_backend = make_backend(
+        backend,
+        dropout=dropout,
+        max_tokens_per_batch=max_tokens_per_batch,
+        command=fold_command,
+        pin_devices=n_workers > 1,
+    )
+
+    # Run inference into 'fold_dir', length sorted batches are sharded over the workers.
+    # Every record is held in memory here since the scheduler sorts them all by length.
+    manifest = schedule_folds(
+        list(iter_bootstrap_records(fasta_dict_no_gaps, n_variants)),
+        fold_dir,
+        fold_backend,
+        n_workers=n_workers,
+        max_tokens_per_batch=max_tokens_per_batch,
+    )
+
+    failed = [id for id, state in manifest.items() if state != 'done']
+    if failed:
+        raise RuntimeError(f'{len(failed)} records failed to fold, rerun with the same fold directory to retry them: {", ".join(failed[:10])}')
+    return fold_dir
+
+def drop_inserts_from_structures(fold_dir: Path, fasta_dict_full: Dict[str, str]) -> Path:
+    from structphy.extract_conserved_pdb import remove_inserts_from_structure
+    from structphy.fasta_loading import sequence_masks
+
+    # Gap and insert columns are worked out once per sequence, not once per folded variant
+    masks = {id: sequence_masks(seq) for id, seq in fasta_dict_full.items()}
+
+    # Make a new _conserved directory then strip the inserts from the folded directory
+    full_pdbs = [(fold_dir / file).resolve() for file in os.listdir(fold_dir) if file.endswith('.pdb')]
+    out_conserved_dir = fold_dir.parent / (fold_dir.name + '_conserved')
+    out_conserved_dir.mkdir(exist_ok=True)
+    for fulL_pdb_file in full_pdbs:
+        pdb_name = fulL_pdb_file.name
+        id = fulL_pdb_file.stem.split('#')[0]
+        pdb_file_out = out_conserved_dir / pdb_name
+        gap_mask, insert_mask = masks[id]
+        remove_inserts_from_structure(fulL_pdb_file,  fasta_dict_full[id], pdb_file_out, gap_mask=gap_mask, insert_mask=insert_mask)
+
+    return out_conserved_dir
+
+def list_structure_files(structdir: Path) -> List[Path]:
+    return [(structdir / file).resolve() for file in os.listdir(structdir) if file.endswith('.pdb')]
+
+def write_bootstrap_matrices(bootstrap_matrices, out_dir: Path):
+    # bootstrap_matrices is a DistanceTensor, each matrix is written from a view of the stacked array
+    (out_dir / 'bootstrap_matrices').mkdir(parents=True, exist_ok=True)
+    for i in range(len(bootstrap_matrices)):
+        bootstrap_matrices.matrix(i).to_csv(out_dir / 'bootstrap_matrices' / f'bootstrap_matrix_{i}.csv', float_format='%.8G')
+
+def build_bootstrap_trees(bootstrap_matrices, n_threads: int, method: str = 'NJ') -> List[str]:
+    from structphy.generate_trees import tensor_to_fastme_newick
+
+    # generate trees from matrices, fake outgroups are added as each matrix is handed to fastme
+    return tensor_to_fastme_newick(bootstrap_matrices, n_threads=n_threads, method=method, outgroup_name=FAKE_OUTGROUP_NAME)
+
+def summarise_bootstrap_trees(bootstrap_trees: List[str], bootstrap_matrices, out_dir: Path, outtree: Path = None, support: str = 'classic', n_threads: int = 1, pool=None) -> str:
+    from structphy.generate_consensus_tree import bootstrap_trees_to_consensus
+    from structphy.branch_lengths import get_upgma_tree
+    from structphy.bootstrapping import bootstrap_against_tree
+
+    # Averaged straight over the tensor, no DataFrame per matrix
+    mean_distance_matrix = bootstrap_matrices.mean_matrix()
+
+    with open(out_dir / 'bootstrap_trees.newick', 'w') as f:
+        for tree in bootstrap_trees:
+            f.write(tree+'\n')
+
+    # generate consensus tree from bootstrap trees
+    consensus_tree = bootstrap_trees_to_consensus(bootstrap_trees, outgroup_name=FAKE_OUTGROUP_NAME)
+    with open(out_dir / 'consensus_tree.newick', 'w') as f:
+        f.write(consensus_tree)
+
+    # reweight the consensus branch lengths using distance matrices and optimise routine
+    # use flag for upgma vs leastsq
+    upgma_tree = get_upgma_tree(consensus_tree, mean_distance_matrix)
+    with open(outtree if outtree else out_dir / 'upgma_tree.newick', 'w') as f:
+        f.write(upgma_tree)
+
+    # optimised_tree = optimise_branch_lengths(upgma_tree, mean_distance_matrix.to_numpy())
+    # print(optimised_tree)
+
+    # bootstrap against the consensus tree
+    # Must be last as ete3 can't read this bootstrap format.
+    bootstrapped_tree = bootstrap_against_tree(bootstrap_trees, upgma_tree, support=support, n_threads=n_threads, pool=pool)
+    with open(outtree if outtree else out_dir / 'boostrapped_upgma_tree.newick', 'w') as f:
+        f.write(bootstrapped_tree)
+
+    return bootstrapped_tree
+
+def run_pipeline(
+        out_dir: Path,
+        n_threads: int,
+        structdir: Path = None,
+        fasta: Path = None,
+        fold_dir: Path = None,
+        dmdir: Path = None,
+        pairdir: Path = None,
+        n_bootstraps: int = 10,
+        n_variants: int = 10,
+        drop_inserts: bool = False,
+        dropout: List[float] = None,
+        metric: str = 'tm_max',
+        method: str = 'NJ',
+        support: str = 'classic',
+        outtree: Path = None,
+        fold_options: dict = None,
+        pool=None,
+    ) -> str:
+    # A whole run, every output goes under out_dir. Returns the bootstrapped tree.
+    # pool is an optional long lived process pool for the support stage.
+
+    if fasta:
+        from structphy.fasta_loading import fasta_to_dict
+
+        # Read fasta file into a dict like {id: sequence, ...}
+        fasta_dict_full, fasta_dict_no_gaps = fasta_to_dict(fasta)
+        structdir = fold_fasta(fasta_dict_no_gaps, fold_dir, n_variants=n_variants, dropout=dropout, **(fold_options or {}))
+
+        # if remove inserts, strip the inserts from the folded directory into a new _conserved directory
+        if drop_inserts:
+            structdir = drop_inserts_from_structures(fold_dir, fasta_dict_full)
+
+    import pandas as pd
+    from structphy.generate_matrices import align_bootstrap_structures, bootstrap_tensor_from_pair_results, save_pair_results, load_pair_results
+    from structphy.distance_tensor import tensor_from_dataframes
+
+    if dmdir is None:
+        if pairdir is None:
+            structure_files = list_structure_files(structdir)
+
+            # Keep every TMalign metric so other distance definitions can be tried later with --pairdir
+            pair_df, samples_df = align_bootstrap_structures(structure_files, n_threads=n_threads, n_bootstraps=n_bootstraps)
+            save_pair_results(pair_df, samples_df, out_dir / 'pair_results')
+        else:
+            print(f'Reading pair results from {pairdir}')
+            pair_df, samples_df = load_pair_results(pairdir)
+            if len(samples_df) < n_bootstraps:
+                print(f'Only {len(samples_df)} bootstraps stored in {pairdir}, using all of them')
+            samples_df = samples_df.head(n_bootstraps)
+
+        # The tensor is released however the rest of the run ends
+        bootstrap_matrices = bootstrap_tensor_from_pair_results(pair_df, samples_df, metric=metric)
+    else:
+        print(f'Reading distance matrices from {dmdir}')
+        bootstrap_matrices_files = [(dmdir / file).resolve() for file in os.listdir(dmdir) if file.endswith('.csv')]
+        bootstrap_matrices = tensor_from_dataframes([pd.read_csv(filename, index_col='Unnamed: 0') for filename in bootstrap_matrices_files])
+
+    with bootstrap_matrices:
+        if dmdir is None:
+            write_bootstrap_matrices(bootstrap_matrices, out_dir)
+        bootstrap_trees = build_bootstrap_trees(bootstrap_matrices, n_threads=n_threads, method=method)
+        return summarise_bootstrap_trees(bootstrap_trees, bootstrap_matrices, out_dir, outtree=outtree, support=support, n_threads=n_threads, pool=pool)
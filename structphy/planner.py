@@ -0,0 +1,340 @@
+from pathlib import Path
+from typing import Dict, List, Tuple
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+# Predicts pair counts, CPU time, memory and disk for a run before it starts.
+# Costs come from a couple of tiny calibration runs of TMalign, fastme and the support stage on this machine:
+# TMalign time grows with the product of the two chain lengths, NJ with the cube of the taxa.
+# Everything here is an estimate to size a job, not a promise.
+
+# Used when a tool isn't installed yet, roughly a 300 x 300 residue TMalign in 0.1 s and a 1000 taxa NJ tree in 1 s
+DEFAULT_TMALIGN_COST = (0.005, 0.1 / 300**2)
+DEFAULT_FASTME_COST = (0.005, 1.0 / 1000**3)
+# Per bootstrap tree against the consensus, see support_units. About 1 s for 1000 taxa either way.
+DEFAULT_SUPPORT_COSTS = {'classic': (0.001, 1.0 / 1000**2), 'tbe': (0.001, 1.0 / (1000 * 10**3))}
+# consense reads every bootstrap tree once, about 1 s for 100 trees of 1000 taxa
+DEFAULT_CONSENSE_COST = (0.01, 1.0 / (100 * 1000**2))
+
+# Bytes per item for the outputs and in-memory tables, measured on typical runs
+PDB_BYTES_PER_RESIDUE = 650 # ESMFold writes every heavy atom, about 8 lines of 81 characters per residue
+PAIR_ROW_BYTES = 250 # pair_results DataFrame row plus both orientations in symmetric_distances
+PAIR_CSV_BYTES = 110
+MATRIX_CSV_BYTES_PER_CELL = 9
+NEWICK_BYTES_PER_TAXON = 30
+# Memory of one TMalign child, its alignment tables are a few doubles per residue pair
+TMALIGN_BASE_BYTES = 5 * 1024**2
+TMALIGN_BYTES_PER_CELL = 24
+# Memory of one fastme child, a handful of taxa x taxa double matrices
+FASTME_BASE_BYTES = 5 * 1024**2
+FASTME_BYTES_PER_CELL = 40
+# ESMFold on the GPU: the weights, then activations dominated by the pair representation,
+# which grows with tokens in the batch times the longest sequence. Set so the default
+# 1300 tokens of 300 residue sequences fit a 16 GB card.
+ESMFOLD_MODEL_BYTES = 8 * 1024**3
+ESMFOLD_BYTES_PER_TOKEN_RESIDUE = 20_000
+
+# Above this many proteins exact clade matches get rare and transfer supports say more
+TBE_RECOMMENDED_TAXA = 100
+
+
+def lengths_from_structures(structure_files: List[Path]) -> Dict[str, List[int]]:
+    from structphy.generate_matrices import count_residues
+
+    # {protein id: [residues of each variant]}
+    lengths = {}
+    for path in structure_files:
+        lengths.setdefault(path.name.split('#')[0], []).append(count_residues(path))
+    return lengths
+
+def lengths_from_fasta(fasta: Path, n_variants: int) -> Dict[str, List[int]]:
+    from structphy.fasta_loading import fasta_to_dict
+
+    _, fasta_dict_no_gaps = fasta_to_dict(fasta)
+    return {id: [len(seq)] * n_variants for id, seq in fasta_dict_no_gaps.items()}
+
+def expected_pair_work(lengths: Dict[str, List[int]], n_bootstraps: int) -> Tuple[int, float, float]:
+    # Returns (pairs requested, expected distinct pairs, expected sum of length products to align).
+    # Each bootstrap draws one variant per protein, so a protein pair with Va * Vb variant combinations
+    # is expected to need Va * Vb * (1 - (1 - 1 / (Va * Vb))^B) distinct alignments over B bootstraps.
+    # Deduplication of identical structures only lowers this.
+    n_variants = np.array([len(variant_lengths) for variant_lengths in lengths.values()], dtype=float)
+    mean_length = np.array([np.mean(variant_lengths) for variant_lengths in lengths.values()], dtype=float)
+    n_proteins = len(n_variants)
+
+    distinct = 0.0
+    work = 0.0
+    for i in range(n_proteins - 1):
+        combinations = n_variants[i] * n_variants[i + 1:]
+        pairs = combinations * (1 - (1 - 1 / combinations) ** n_bootstraps)
+        distinct += pairs.sum()
+        work += (pairs * mean_length[i] * mean_length[i + 1:]).sum()
+
+    requested = n_bootstraps * n_proteins * (n_proteins - 1) // 2
+    return requested, distinct, work
+
+def fit_cost(sizes: List[float], seconds: List[float]) -> Tuple[float, float]:
+    # Least squares fit of seconds = overhead + per_unit * size, both kept non-negative
+    per_unit, overhead = np.polyfit(sizes, seconds, 1) if len(set(sizes)) > 1 else (seconds[0] / sizes[0], 0.0)
+    return max(overhead, 0.0), max(per_unit, 1e-15)
+
+def calibrate_tmalign(structure_files: List[Path], tmalign_path: Path, n_pairs: int = 4) -> Tuple[float, float]:
+    from structphy.generate_matrices import count_residues
+    from structphy.fold_scheduler import stub_pdb_lines
+
+    # Real structures when there are some, otherwise placeholder chains of a few lengths
+    with tempfile.TemporaryDirectory() as tmp:
+        if not structure_files:
+            structure_files = []
+            for length in (50, 150, 300):
+                path = Path(tmp) / f'calibrate_{length}.pdb'
+                with open(path, 'w') as f:
+                    f.writelines(stub_pdb_lines(path.stem, 'A' * length))
+                structure_files.append(path)
+
+        pairs = [tuple(random.sample(structure_files, 2)) for _ in range(n_pairs)]
+        sizes, seconds = [], []
+        for pdb1, pdb2 in pairs:
+            start = time.perf_counter()
+            subprocess.run([str(tmalign_path), str(pdb1), str(pdb2)], capture_output=True, check=True)
+            seconds.append(time.perf_counter() - start)
+            sizes.append(count_residues(pdb1) * count_residues(pdb2))
+
+    return fit_cost(sizes, seconds)
+
+def calibrate_fastme(n_taxa: int, method: str = 'NJ') -> Tuple[float, float]:
+    from structphy.generate_trees import fastme, phylip_from_array
+
+    # Two sizes so the process start up can be told apart from the cubic part
+    sizes, seconds = [], []
+    for n in sorted({8, min(max(n_taxa, 16), 256)}):
+        points = np.random.rand(n, 3)
+        distances = np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=-1))
+        phylip = phylip_from_array([f't{i}' for i in range(n)], distances)
+        start = time.perf_counter()
+        fastme(phylip, method=method)
+        seconds.append(time.perf_counter() - start)
+        sizes.append(n ** 3)
+
+    return fit_cost(sizes, seconds)
+
+def support_units(n_taxa: int, support: str) -> float:
+    # Classic support compares every clade of the consensus with every clade of a bootstrap tree,
+    # the transfer bootstrap marks each taxon O(log n) times with O(log^2 n) updates per mark
+    if support == 'tbe':
+        return n_taxa * max(np.log2(n_taxa), 1) ** 3
+    return n_taxa ** 2
+
+def calibrate_support(n_taxa: int, support: str = 'classic', n_trees: int = 4) -> Tuple[float, float]:
+    from ete3 import Tree
+    from structphy.bootstrapping import classic_supports
+    from structphy.transfer_bootstrap import transfer_indices
+
+    # Random trees, the cost depends on the number of taxa much more than on the shapes
+    sizes, seconds = [], []
+    for n in sorted({8, min(max(n_taxa, 16), 256)}):
+        names = [f't{i}' for i in range(n)]
+        trees = []
+        for _ in range(n_trees + 1):
+            tree = Tree()
+            tree.populate(n, names_library=names)
+            trees.append(tree)
+        reference, bootstrap_trees = trees[0], trees[1:]
+        start = time.perf_counter()
+        if support == 'tbe':
+            for bootstrap_tree in bootstrap_trees:
+                transfer_indices(reference, bootstrap_tree)
+        else:
+            classic_supports([tree.write(format=5) for tree in bootstrap_trees], reference)
+        seconds.append((time.perf_counter() - start) / n_trees)
+        sizes.append(support_units(n, support))
+
+    return fit_cost(sizes, seconds)
+
+def available_gpus() -> List[int]:
+    # Memory of each visible NVIDIA GPU in bytes, empty when there are none or nvidia-smi is missing
+    try:
+        completed = subprocess.run(['nvidia-smi', '--query-gpu=memory.total', '--format=csv,noheader,nounits'], capture_output=True, text=True, check=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return [int(float(line)) * 1024**2 for line in completed.stdout.split() if line.strip()]
+
+def recommend_fold(lengths: Dict[str, List[int]], max_tokens_per_batch: int, gpus: List[int]) -> Dict:
+    # Largest token budget that fits the smallest GPU, and one worker per GPU
+    longest = max(max(variant_lengths) for variant_lengths in lengths.values())
+    if not gpus:
+        return {'max_tokens_per_batch': max(max_tokens_per_batch, longest), 'fold_workers': 1, 'fits': None}
+    free = min(gpus) - ESMFOLD_MODEL_BYTES
+    tokens = int(free // (ESMFOLD_BYTES_PER_TOKEN_RESIDUE * longest)) if free > 0 else 0
+    return {'max_tokens_per_batch': max(tokens, longest), 'fold_workers': len(gpus), 'fits': tokens >= longest}
+
+def available_memory() -> int:
+    # Physical memory, 0 when unknown
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+def make_plan(
+        lengths: Dict[str, List[int]],
+        n_bootstraps: int,
+        n_threads: int,
+        tmalign_cost: Tuple[float, float] = DEFAULT_TMALIGN_COST,
+        fastme_cost: Tuple[float, float] = DEFAULT_FASTME_COST,
+        fold: bool = False,
+        max_tokens_per_batch: int = 1300,
+        support: str = 'classic',
+        support_cost: Tuple[float, float] = None,
+        consense_cost: Tuple[float, float] = DEFAULT_CONSENSE_COST,
+    ) -> Dict:
+    n_proteins = len(lengths)
+    n_structures = sum(len(variant_lengths) for variant_lengths in lengths.values())
+    n_residues = sum(sum(variant_lengths) for variant_lengths in lengths.values())
+    requested, distinct, work = expected_pair_work(lengths, n_bootstraps)
+
+    stages = {}
+
+    if fold:
+        from structphy.fold_scheduler import pack_batches
+        records = [(f'{id}#{i}', 'A' * length) for id, variant_lengths in lengths.items() for i, length in enumerate(variant_lengths)]
+        stages['fold'] = {
+            'structures': n_structures,
+            'tokens': n_residues,
+            'batches': len(pack_batches(records, max_tokens_per_batch)),
+            'disk_bytes': n_residues * PDB_BYTES_PER_RESIDUE,
+        }
+
+    align_cpu = distinct * tmalign_cost[0] + work * tmalign_cost[1]
+    stages['align'] = {
+        'pairs_requested': requested,
+        'pairs_distinct': round(distinct),
+        'cpu_seconds': align_cpu,
+        'wall_seconds': align_cpu / max(1, min(n_threads, round(distinct) or 1)),
+        'memory_bytes': distinct * PAIR_ROW_BYTES,
+        'disk_bytes': distinct * PAIR_CSV_BYTES,
+    }
+
+    tensor_bytes = n_bootstraps * n_proteins ** 2 * 8
+    stages['matrices'] = {
+        'tensor_bytes': tensor_bytes,
+        'memory_bytes': tensor_bytes + distinct * PAIR_ROW_BYTES,
+        'disk_bytes': n_bootstraps * n_proteins ** 2 * MATRIX_CSV_BYTES_PER_CELL,
+    }
+
+    # Trees are built with the fake outgroup added
+    tree_cpu = n_bootstraps * (fastme_cost[0] + fastme_cost[1] * (n_proteins + 1) ** 3)
+    stages['trees'] = {
+        'cpu_seconds': tree_cpu,
+        'wall_seconds': tree_cpu / max(1, min(n_threads, n_bootstraps)),
+        'disk_bytes': n_bootstraps * n_proteins * NEWICK_BYTES_PER_TAXON,
+    }
+
+    # Support of every consensus branch against each bootstrap, then consense over all of them.
+    # Classic support runs in this process, transfer supports are spread over a process pool.
+    support_cost = support_cost or DEFAULT_SUPPORT_COSTS[support]
+    support_cpu = n_bootstraps * (support_cost[0] + support_cost[1] * support_units(n_proteins, support))
+    consense_cpu = consense_cost[0] + consense_cost[1] * n_bootstraps * (n_proteins + 1) ** 2
+    stages['support'] = {
+        'support': support,
+        'cpu_seconds': support_cpu + consense_cpu,
+        'wall_seconds': consense_cpu + (support_cpu / max(1, min(n_threads, n_bootstraps)) if support == 'tbe' else support_cpu),
+    }
+
+    memory = available_memory()
+    peak_memory = max(stage.get('memory_bytes', 0) for stage in stages.values())
+
+    # Each concurrent TMalign or fastme child needs its own memory on top of the run's tables,
+    # so threads are capped by what fits as well as by cores and work
+    longest = max(max(variant_lengths) for variant_lengths in lengths.values())
+    child_bytes = max(TMALIGN_BASE_BYTES + TMALIGN_BYTES_PER_CELL * longest ** 2, FASTME_BASE_BYTES + FASTME_BYTES_PER_CELL * (n_proteins + 1) ** 2)
+    threads = max(1, min(os.cpu_count() or 1, round(distinct) or 1))
+    if memory:
+        threads = max(1, min(threads, int((memory - peak_memory) // child_bytes)))
+    # A service running jobs like this one, each with at least one child
+    job_bytes = peak_memory + child_bytes
+    max_jobs = max(1, min(os.cpu_count() or 1, int(memory // job_bytes) if memory else 1))
+
+    recommended = {
+        'threads': threads,
+        'support': 'tbe' if n_proteins >= TBE_RECOMMENDED_TAXA else 'classic',
+        'child_memory_bytes': child_bytes,
+        'serve_max_jobs': max_jobs,
+    }
+    warnings = []
+    if fold:
+        fold_recommendation = recommend_fold(lengths, max_tokens_per_batch, available_gpus())
+        recommended.update(max_tokens_per_batch=fold_recommendation['max_tokens_per_batch'], fold_workers=fold_recommendation['fold_workers'])
+        if fold_recommendation['fits'] is False:
+            warnings.append(f'The longest sequence ({longest} residues) may not fit in GPU memory on its own')
+        if max_tokens_per_batch < longest:
+            warnings.append(f'--max_tokens_per_batch {max_tokens_per_batch} is below the longest sequence ({longest} residues), it will be folded alone')
+    if memory and peak_memory > memory:
+        warnings.append(f'Peak memory {format_bytes(peak_memory)} is more than the {format_bytes(memory)} on this machine')
+
+    return {
+        'inputs': {
+            'proteins': n_proteins,
+            'structures': n_structures,
+            'mean_length': n_residues / max(n_structures, 1),
+            'n_bootstraps': n_bootstraps,
+            'threads': n_threads,
+        },
+        'calibration': {'tmalign': tmalign_cost, 'fastme': fastme_cost, 'support': support_cost, 'consense': consense_cost},
+        'stages': stages,
+        'cpu_hours': (align_cpu + tree_cpu + stages['support']['cpu_seconds']) / 3600,
+        'wall_hours': (stages['align']['wall_seconds'] + stages['trees']['wall_seconds'] + stages['support']['wall_seconds']) / 3600,
+        'peak_memory_bytes': peak_memory,
+        'disk_bytes': sum(stage.get('disk_bytes', 0) for stage in stages.values()),
+        'recommended': recommended,
+        'warnings': warnings,
+    }
+
+def format_bytes(n: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if n < 1024 or unit == 'TB':
+            return f'{n:.1f} {unit}'
+        n /= 1024
+
+def format_seconds(seconds: float) -> str:
+    if seconds < 60:
+        return f'{seconds:.1f} s'
+    if seconds < 3600:
+        return f'{seconds / 60:.1f} min'
+    if seconds < 48 * 3600:
+        return f'{seconds / 3600:.1f} h'
+    return f'{seconds / 86400:.1f} days'
+
+def print_plan(plan: Dict):
+    inputs = plan['inputs']
+    print(f'Proteins: {inputs["proteins"]}, structures: {inputs["structures"]}, mean length: {inputs["mean_length"]:.0f} residues, bootstraps: {inputs["n_bootstraps"]}')
+
+    stages = plan['stages']
+    if 'fold' in stages:
+        fold = stages['fold']
+        print(f'  fold      {fold["structures"]} structures, {fold["tokens"]} tokens in {fold["batches"]} batches (GPU), disk {format_bytes(fold["disk_bytes"])}')
+    align = stages['align']
+    print(f'  align     {align["pairs_requested"]} pairs requested, ~{align["pairs_distinct"]} distinct, '
+          f'CPU {format_seconds(align["cpu_seconds"])}, wall {format_seconds(align["wall_seconds"])}, '
+          f'memory {format_bytes(align["memory_bytes"])}, disk {format_bytes(align["disk_bytes"])}')
+    matrices = stages['matrices']
+    print(f'  matrices  tensor {format_bytes(matrices["tensor_bytes"])}, memory {format_bytes(matrices["memory_bytes"])}, disk {format_bytes(matrices["disk_bytes"])}')
+    trees = stages['trees']
+    print(f'  trees     CPU {format_seconds(trees["cpu_seconds"])}, wall {format_seconds(trees["wall_seconds"])}, disk {format_bytes(trees["disk_bytes"])}')
+    support = stages['support']
+    print(f'  support   {support["support"]} and consense, CPU {format_seconds(support["cpu_seconds"])}, wall {format_seconds(support["wall_seconds"])}')
+
+    print(f'Total: {plan["cpu_hours"]:.2f} CPU hours, {format_seconds(plan["wall_hours"] * 3600)} wall with {inputs["threads"]} threads, '
+          f'peak memory {format_bytes(plan["peak_memory_bytes"])}, disk {format_bytes(plan["disk_bytes"])}')
+
+    recommended = plan['recommended']
+    print(f'Recommended: --threads {recommended["threads"]} --support {recommended["support"]}', end='')
+    if 'max_tokens_per_batch' in recommended:
+        print(f' --max_tokens_per_batch {recommended["max_tokens_per_batch"]} --fold_workers {recommended["fold_workers"]}', end='')
+    print(f', structphy serve --max_jobs {recommended["serve_max_jobs"]} for jobs like this one')
+    for warning in plan['warnings']:
+        print(f'Warning: {warning}')
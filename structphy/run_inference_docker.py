@@ -6,19 +6,26 @@ def run_esm_dropouts(
         share_dir: Path, 
         fasta_in: Path,
         dropout: List[float] = None,
-        max_tokens_per_batch: int = 800
+        max_tokens_per_batch: int = 800,
+        container_name: str = 'structphy-exec',
+        device_ids: List[str] = None,
     ) -> Path:
     
     container = None
     try:
         share_dir_docker = '/home/appuser/bus'
         client = docker.from_env()
+        # All GPUs unless the caller pins this container to specific devices
+        if device_ids:
+            device_request = docker.types.DeviceRequest(device_ids=device_ids, capabilities=[['gpu']])
+        else:
+            device_request = docker.types.DeviceRequest(count=-1, capabilities=[['gpu']])
         container = client.containers.run(
             'finnod/structphy-esmdropouts-openfold',
-            name='structphy-exec',
+            name=container_name,
             detach=True,
             tty=True,
-            device_requests=[docker.types.DeviceRequest(count=-1, capabilities=[['gpu']])],
+            device_requests=[device_request],
             volumes={str(share_dir.resolve()): {'bind': share_dir_docker, 'mode': 'rw'}},
             user='appuser',
         )
@@ -30,7 +37,7 @@ def run_esm_dropouts(
         # Docker local files
         pybin = '/opt/conda/envs/esmfold/bin/python3'
         infer = 'esm-dropouts/scripts/esmfold_inference.py'
-        input_fa_full = f'{share_dir_docker}/{str(fasta_in.name)}'
+        input_fa_full = f'{share_dir_docker}/{fasta_in.resolve().relative_to(share_dir.resolve()).as_posix()}'
         output_dir_docker = share_dir_docker
         
         # Make the output dir
@@ -0,0 +1,412 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import collections
+import multiprocessing.pool
+import hmac
+import json
+import os
+import secrets
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+
+# Long running structphy. One process keeps the imports and the TMalign pair cache warm,
+# and runs jobs submitted over a small HTTP API. Each job gets its own directory under the
+# service root so concurrent jobs never share outputs, and jobs are taken round-robin
+# between clients. TMalign and fastme run as children of each job's own event loop, the
+# only process pool is for transfer bootstrap supports and is started by the first
+# 'tbe' job, then kept for the ones after it.
+#
+# Every request needs 'Authorization: Bearer <token>' with the token from structphy serve,
+# and bodies have to be sent as application/json. Requests carrying an Origin header are
+# refused, so a web page open in a browser on the same machine can't submit jobs. How to
+# fold is fixed when the service starts, jobs can't choose the backend or a command to run.
+#
+#   POST /jobs            {"structdir": "...", "n_bootstraps": 10, ...}  -> job
+#   GET  /jobs            every job
+#   GET  /jobs/<id>       one job
+#   GET  /jobs/<id>/tree  the bootstrapped tree once the job is done
+#   GET  /health          queue and cache sizes
+
+# Everything a job can set and its default, same meaning as the CLI options
+JOB_DEFAULTS = {
+    'structdir': None,
+    'fasta': None,
+    'pairdir': None,
+    'dmdir': None,
+    'n_bootstraps': 10,
+    'n_variants': 10,
+    'drop_inserts': False,
+    'dropout': None,
+    'metric': 'tm_max',
+    'method': 'NJ',
+    'support': 'classic',
+    'max_tokens_per_batch': 1300,
+    'client': 'default',
+}
+INPUT_KEYS = ['structdir', 'fasta', 'pairdir', 'dmdir']
+TREE_NAME = 'boostrapped_upgma_tree.newick'
+TOKEN_NAME = 'service_token'
+MAX_BODY_BYTES = 1 << 20
+
+
+def parse_job_options(options: Dict[str, Any]) -> Dict[str, Any]:
+    from structphy.metrics import METRICS
+    from structphy.generate_trees import FASTME_METHODS
+
+    unknown = set(options) - set(JOB_DEFAULTS)
+    if unknown:
+        raise ValueError(f'Unknown job options {", ".join(sorted(unknown))}, expected some of {", ".join(JOB_DEFAULTS)}')
+    options = dict(JOB_DEFAULTS, **options)
+
+    inputs = [key for key in INPUT_KEYS if options[key]]
+    if len(inputs) != 1:
+        raise ValueError(f'Exactly one of {", ".join(INPUT_KEYS)} has to be given')
+    # Paths are on the service's machine, relative ones are taken from where it was started
+    for key in INPUT_KEYS:
+        if options[key]:
+            options[key] = Path(options[key]).resolve()
+            if not options[key].exists():
+                raise ValueError(f'{key} {options[key]} does not exist')
+
+    # Checked on submit, a bad value would otherwise only fail after every fold and alignment had run
+    def invalid(key, expected):
+        raise ValueError(f'Invalid {key} {options[key]!r}, expected {expected}')
+
+    for key in ['n_bootstraps', 'n_variants', 'max_tokens_per_batch']:
+        if isinstance(options[key], bool) or not isinstance(options[key], int) or options[key] < 1:
+            invalid(key, 'a positive integer')
+    if not isinstance(options['drop_inserts'], bool):
+        invalid('drop_inserts', 'true or false')
+    if options['metric'] not in METRICS:
+        invalid('metric', f'one of {", ".join(METRICS)}')
+    if options['method'] not in FASTME_METHODS:
+        invalid('method', f'one of {", ".join(FASTME_METHODS)}')
+    if options['support'] not in ('classic', 'tbe'):
+        invalid('support', 'classic or tbe')
+    if options['dropout'] is not None:
+        dropout = options['dropout']
+        try:
+            if isinstance(dropout, str):
+                dropout = [float(x) for x in dropout.split(',')]
+            elif isinstance(dropout, list):
+                dropout = [float(x) for x in dropout]
+            elif isinstance(dropout, (int, float)) and not isinstance(dropout, bool):
+                dropout = [float(dropout)]
+            else:
+                raise TypeError
+        except (TypeError, ValueError):
+            invalid('dropout', 'null, a number, a list of numbers or a comma separated string')
+        options['dropout'] = dropout
+
+    return options
+
+class Job:
+
+    def __init__(self, options: Dict[str, Any], root: Path):
+        self.id = uuid.uuid4().hex[:12]
+        self.options = options
+        self.client = str(options['client'])
+        self.job_dir = root / self.id
+        self.status = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'client': self.client,
+            'status': self.status,
+            'error': self.error,
+            'job_dir': str(self.job_dir),
+            'options': {key: str(value) if isinstance(value, Path) else value for key, value in self.options.items()},
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'outputs': sorted(os.listdir(self.job_dir)) if self.job_dir.exists() else [],
+        }
+
+class FairQueue:
+    # One FIFO per client, clients are served round-robin so a client with a
+    # hundred queued jobs doesn't hold up one with a single job
+
+    def __init__(self):
+        self.queues = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def put(self, job: Job):
+        with self.condition:
+            self.queues.setdefault(job.client, collections.deque()).append(job)
+            self.condition.notify()
+
+    def get(self) -> Optional[Job]:
+        # Blocks for the next job, None once the queue is closed. Jobs still queued then are left alone.
+        with self.condition:
+            while not self.queues and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            client, queue = next(iter(self.queues.items()))
+            job = queue.popleft()
+            # The client goes to the back of the line, or leaves it when it has nothing queued
+            del self.queues[client]
+            if queue:
+                self.queues[client] = queue
+            return job
+
+    def __len__(self):
+        with self.condition:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class JobService:
+
+    def __init__(self, root: Path, n_threads: int, max_jobs: int = 2, fold_backend: str = 'docker', fold_command: str = None):
+        self.root = root
+        # Folding is set up by whoever starts the service, never by a job
+        self.fold_backend = fold_backend
+        self.fold_command = fold_command
+        self.n_threads = max(1, n_threads)
+        self.max_jobs = max(1, max_jobs)
+        # Each running job gets an equal share of the TMalign concurrency
+        self.threads_per_job = max(1, self.n_threads // self.max_jobs)
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.queue = FairQueue()
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.runners = []
+
+    def start(self):
+        # Import the pipeline up front so no job pays for it
+        import structphy.pipeline, structphy.generate_matrices, structphy.generate_trees, structphy.transfer_bootstrap, structphy.bootstrapping, structphy.branch_lengths
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        for _ in range(self.max_jobs):
+            runner = threading.Thread(target=self.run_jobs, daemon=True)
+            runner.start()
+            self.runners.append(runner)
+
+    def shutdown(self):
+        self.queue.close()
+        for runner in self.runners:
+            runner.join()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def support_pool(self) -> multiprocessing.pool.Pool:
+        # Started by the first transfer bootstrap job and kept for later ones. Runner threads
+        # exist by then, so workers come from a forkserver rather than forking this process.
+        with self.pool_lock:
+            if self.pool is None:
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['structphy.transfer_bootstrap'])
+                self.pool = context.Pool(self.n_threads)
+            return self.pool
+
+    def submit(self, options: Dict[str, Any]) -> Job:
+        job = Job(parse_job_options(options), self.root)
+        with self.jobs_lock:
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self.jobs_lock:
+            return list(self.jobs.values())
+
+    def health(self) -> Dict[str, Any]:
+        from structphy.generate_matrices import _tmalign_results
+        statuses = collections.Counter(job.status for job in self.list())
+        return {
+            'queued': len(self.queue),
+            'jobs': dict(statuses),
+            'cached_alignments': len(_tmalign_results),
+            'support_pool': self.pool is not None,
+            'threads': self.n_threads,
+            'max_jobs': self.max_jobs,
+        }
+
+    def run_jobs(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self.run_job(job)
+
+    def run_job(self, job: Job):
+        from structphy.pipeline import run_pipeline
+
+        options = job.options
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.job_dir.mkdir(parents=True)
+            fold_dir = None
+            if options['fasta']:
+                fold_dir = job.job_dir / 'folddir'
+                fold_dir.mkdir()
+            run_pipeline(
+                job.job_dir,
+                n_threads=self.threads_per_job,
+                structdir=options['structdir'],
+                fasta=options['fasta'],
+                fold_dir=fold_dir,
+                dmdir=options['dmdir'],
+                pairdir=options['pairdir'],
+                n_bootstraps=options['n_bootstraps'],
+                n_variants=options['n_variants'],
+                drop_inserts=options['drop_inserts'],
+                dropout=options['dropout'],
+                metric=options['metric'],
+                method=options['method'],
+                support=options['support'],
+                fold_options={
+                    'backend': self.fold_backend,
+                    'max_tokens_per_batch': options['max_tokens_per_batch'],
+                    'fold_command': self.fold_command,
+                },
+                pool=self.support_pool() if options['support'] == 'tbe' else None,
+            )
+            job.status = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = f'{type(e).__name__}: {e}'
+            traceback.print_exc()
+        finally:
+            job.finished = time.time()
+            if job.job_dir.exists():
+                with open(job.job_dir / 'job.json', 'w') as f:
+                    json.dump(job.to_dict(), f, indent=2)
+
+def load_token(root: Path) -> str:
+    # The token kept in the service root, made on first use and only readable by its owner
+    token_path = root / TOKEN_NAME
+    if not token_path.exists():
+        root.mkdir(parents=True, exist_ok=True)
+        fd = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_urlsafe(32))
+    return token_path.read_text().strip()
+
+def make_handler(service: JobService, token: str):
+
+    class JobHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status: int, body: Any):
+            data = json.dumps(body, indent=2).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_text(self, status: int, text: str):
+            data = text.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def refuse(self) -> bool:
+            # Sends the error and returns True when the request mustn't be served
+            if self.headers.get('Origin') is not None:
+                self.send_json(403, {'error': 'Cross-origin requests are not accepted'})
+                return True
+            scheme, _, given = self.headers.get('Authorization', '').partition(' ')
+            if scheme.lower() != 'bearer' or not hmac.compare_digest(given.strip().encode(), token.encode()):
+                self.send_json(401, {'error': 'Missing or wrong token, send Authorization: Bearer <token>'})
+                return True
+            return False
+
+        def do_GET(self):
+            if self.refuse():
+                return
+            parts = [part for part in self.path.split('?')[0].split('/') if part]
+            if parts == ['health']:
+                return self.send_json(200, service.health())
+            if parts == ['jobs']:
+                return self.send_json(200, [job.to_dict() for job in service.list()])
+            if len(parts) in (2, 3) and parts[0] == 'jobs':
+                job = service.get(parts[1])
+                if job is None:
+                    return self.send_json(404, {'error': f'No job {parts[1]}'})
+                if len(parts) == 2:
+                    return self.send_json(200, job.to_dict())
+                if parts[2] == 'tree':
+                    if job.status != 'done':
+                        return self.send_json(409, {'error': f'Job {job.id} is {job.status}'})
+                    with open(job.job_dir / TREE_NAME) as f:
+                        return self.send_text(200, f.read())
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.refuse():
+                return
+            if self.path.rstrip('/') != '/jobs':
+                return self.send_json(404, {'error': f'Unknown path {self.path}'})
+            if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+                return self.send_json(415, {'error': 'Job options have to be sent as Content-Type: application/json'})
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                if length > MAX_BODY_BYTES:
+                    return self.send_json(413, {'error': f'Job options over {MAX_BODY_BYTES} bytes'})
+                options = json.loads(self.rfile.read(length) or b'{}')
+                if not isinstance(options, dict):
+                    raise ValueError('Job options have to be a JSON object')
+                job = service.submit(options)
+            except ValueError as e:
+                return self.send_json(400, {'error': str(e)})
+            self.send_json(202, job.to_dict())
+
+        def address_string(self):
+            # Unix socket clients have no address
+            return self.client_address[0] if self.client_address else 'unix'
+
+    return JobHandler
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # BaseHTTPRequestHandler expects these
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def serve(service: JobService, token: str, host: str = '127.0.0.1', port: int = 8765, socket_path: Path = None):
+    handler = make_handler(service, token)
+    if socket_path:
+        if socket_path.exists():
+            socket_path.unlink()
+        server = UnixHTTPServer(str(socket_path), handler)
+        print(f'structphy service listening on {socket_path}, jobs in {service.root}')
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f'structphy service listening on http://{host}:{server.server_port}, jobs in {service.root}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        if socket_path and socket_path.exists():
+            socket_path.unlink()
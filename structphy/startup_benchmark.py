@@ -0,0 +1,65 @@
+from typing import Dict, List, Tuple
+import subprocess
+import sys
+import re
+
+import click
+
+
+# Modules that should only ever be imported inside the pipeline stages that need them
+HEAVY_MODULES = ['pandas', 'numpy', 'ete3', 'dendropy', 'phylodm', 'lmfit', 'requests', 'docker']
+
+importtime_re = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+def parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    # Returns {module: (self_us, cumulative_us)} for every module imported
+    imports = {}
+    for line in stderr.splitlines():
+        match = importtime_re.match(line)
+        if match:
+            imports[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+
+    return imports
+
+def measure_startup(args: List[str]) -> Tuple[subprocess.CompletedProcess, Dict[str, Tuple[int, int]]]:
+    command = [sys.executable, '-X', 'importtime', '-m', 'structphy'] + args
+    process = subprocess.run(command, capture_output=True, text=True)
+    return process, parse_importtime(process.stderr)
+
+@click.command()
+@click.option('--budget_ms', type=float, default=150.0, show_default=True, help='Maximum total import time for a cold start.')
+@click.option('--repeats', type=int, default=5, show_default=True)
+@click.option('--args', 'cli_args', type=str, default='--help', show_default=True, help='Arguments to start the CLI with.')
+def main(budget_ms: float, repeats: int, cli_args: str):
+    # Run the CLI a few times under -X importtime and keep the fastest, the first run pays for
+    # cold disk caches and .pyc compilation which isn't what we are budgeting for.
+    runs = [measure_startup(cli_args.split()) for _ in range(repeats)]
+    _, imports = min(runs, key=lambda run: sum(self_us for self_us, _ in run[1].values()))
+    total_ms = sum(self_us for self_us, _ in imports.values()) / 1000
+
+    slowest = sorted(imports.items(), key=lambda item: item[1][1], reverse=True)[:10]
+    click.echo(f'Import time for `structphy {cli_args}`: {total_ms:.1f} ms (budget {budget_ms:.1f} ms)')
+    for module, (_, cumulative_us) in slowest:
+        click.echo(f'  {cumulative_us/1000:8.1f} ms  {module}')
+
+    failures = []
+    # A CLI that crashes, or never runs, imports very little, so the timing alone proves nothing
+    for process, _ in runs:
+        if process.returncode != 0:
+            failures.append(f'`structphy {cli_args}` exited with {process.returncode}: {process.stderr.strip().splitlines()[-1:]}')
+            break
+        if '--help' in cli_args.split() and 'Usage:' not in process.stdout:
+            failures.append(f'`structphy {cli_args}` did not print the usage text')
+            break
+    heavy = [module for module in HEAVY_MODULES if module in imports]
+    if heavy:
+        failures.append(f'Heavy modules imported at startup: {", ".join(heavy)}')
+    if total_ms > budget_ms:
+        failures.append(f'Startup import time {total_ms:.1f} ms is over the {budget_ms:.1f} ms budget')
+
+    for failure in failures:
+        click.echo(failure, err=True)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+import itertools
+import json
+
+from structphy.pipeline import fold_fasta, drop_inserts_from_structures, list_structure_files, write_bootstrap_matrices, build_bootstrap_trees, summarise_bootstrap_trees
+
+# Settings that can be swept and the value a single run would use
+SWEEP_DEFAULTS = {
+    'dropout': None,
+    'drop_inserts': False,
+    'n_bootstraps': 10,
+    'metric': 'tm_max',
+    'method': 'NJ',
+    'support': 'classic',
+}
+
+# Each stage depends on the settings listed here plus the output of the stage before it.
+# Configurations that agree on a stage's settings share its result. Matrices and trees are
+# made for the largest n_bootstraps and smaller n take the first n of them, so they don't
+# depend on n_bootstraps.
+STAGE_KEYS = {
+    'structures': ['dropout'],
+    'conserved': ['dropout', 'drop_inserts'],
+    'pairs': ['dropout', 'drop_inserts'],
+    'matrices': ['dropout', 'drop_inserts', 'metric'],
+    'trees': ['dropout', 'drop_inserts', 'metric', 'method'],
+    'consensus': ['dropout', 'drop_inserts', 'n_bootstraps', 'metric', 'method', 'support'],
+}
+
+
+def load_grid(grid_file: Path) -> Dict[str, List[Any]]:
+    with open(grid_file) as f:
+        grid = json.load(f)
+
+    unknown = set(grid) - set(SWEEP_DEFAULTS)
+    if unknown:
+        raise ValueError(f'Unknown sweep settings {", ".join(sorted(unknown))}, expected some of {", ".join(SWEEP_DEFAULTS)}')
+
+    # Single values are allowed as a shorthand for a one item list
+    grid = {key: value if isinstance(value, list) else [value] for key, value in grid.items()}
+
+    # Dropout sets are kept as '0.1,0.2' strings, like --dropout, so configurations stay hashable
+    if 'dropout' in grid:
+        grid['dropout'] = [','.join(str(x) for x in dropout) if isinstance(dropout, list) else dropout for dropout in grid['dropout']]
+
+    validate_grid(grid)
+    return grid
+
+def validate_grid(grid: Dict[str, List[Any]]):
+    # Checked up front, a bad value would otherwise only fail after every fold and alignment had run
+    from structphy.metrics import METRICS
+    from structphy.generate_trees import FASTME_METHODS
+
+    def invalid(key, value, expected):
+        raise ValueError(f'Invalid sweep {key} {value!r}, expected {expected}')
+
+    for dropout in grid.get('dropout', []):
+        if dropout is None:
+            continue
+        try:
+            [float(x) for x in str(dropout).split(',')]
+        except ValueError:
+            invalid('dropout', dropout, 'null, a number or a list of numbers')
+    for drop_inserts in grid.get('drop_inserts', []):
+        if not isinstance(drop_inserts, bool):
+            invalid('drop_inserts', drop_inserts, 'true or false')
+    for n_bootstraps in grid.get('n_bootstraps', []):
+        if isinstance(n_bootstraps, bool) or not isinstance(n_bootstraps, int) or n_bootstraps < 1:
+            invalid('n_bootstraps', n_bootstraps, 'a positive integer')
+    for metric in grid.get('metric', []):
+        if metric not in METRICS:
+            invalid('metric', metric, f'one of {", ".join(METRICS)}')
+    for method in grid.get('method', []):
+        if method not in FASTME_METHODS:
+            invalid('method', method, f'one of {", ".join(FASTME_METHODS)}')
+    for support in grid.get('support', []):
+        if support not in ('classic', 'tbe'):
+            invalid('support', support, 'classic or tbe')
+
+def sweep_configurations(grid: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    settings = {key: grid.get(key, [default]) for key, default in SWEEP_DEFAULTS.items()}
+    return [dict(zip(settings, values)) for values in itertools.product(*settings.values())]
+
+def config_name(config: Dict[str, Any]) -> str:
+    dropout = config['dropout'] if config['dropout'] else 'none'
+    inserts = 'noinserts' if config['drop_inserts'] else 'inserts'
+    return f'dropout-{dropout}_{inserts}_n{config["n_bootstraps"]}_{config["metric"]}_{config["method"]}_{config["support"]}'
+
+def stage_key(stage: str, config: Dict[str, Any]) -> Tuple:
+    return tuple(config[key] for key in STAGE_KEYS[stage])
+
+def run_stage(cache: Dict[Tuple, Any], counts: Dict[str, List[int]], stage: str, config: Dict[str, Any], compute: Callable[[], Any]) -> Any:
+    # Memoised stage lookup, counts[stage] is [times computed, times requested]
+    key = (stage,) + stage_key(stage, config)
+    counts.setdefault(stage, [0, 0])[1] += 1
+    if key not in cache:
+        counts[stage][0] += 1
+        cache[key] = compute()
+    return cache[key]
+
+def run_sweep(grid: Dict[str, List[Any]], out_dir: Path, n_threads: int, structdir: Path = None, fasta: Path = None, n_variants: int = 10, fold_options: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+    from structphy.generate_matrices import align_bootstrap_structures, bootstrap_tensor_from_pair_results, save_pair_results
+
+    configs = sweep_configurations(grid)
+    if structdir is not None and any(config['dropout'] or config['drop_inserts'] for config in configs):
+        raise ValueError('dropout and drop_inserts can only be swept when folding from a fasta file')
+
+    if fasta is not None:
+        from structphy.fasta_loading import fasta_to_dict
+        fasta_dict_full, fasta_dict_no_gaps = fasta_to_dict(fasta)
+
+    # Bootstraps are sampled once for the largest n and every smaller n uses a prefix of them
+    max_bootstraps = {}
+    for config in configs:
+        key = stage_key('pairs', config)
+        max_bootstraps[key] = max(max_bootstraps.get(key, 0), config['n_bootstraps'])
+
+    def structures(config):
+        if structdir is not None:
+            return structdir
+        from structphy.fold_scheduler import MANIFEST_NAME
+        fold_dir = out_dir / 'structures' / f'dropout-{config["dropout"] or "none"}'
+        # A rerun into the same outdir resumes an earlier fold, anything else there could mix up PDBs
+        if fold_dir.exists() and any(fold_dir.iterdir()) and not (fold_dir / MANIFEST_NAME).exists():
+            raise ValueError(f'Tried to fold into {fold_dir}, but it wasn\'t empty and holds no {MANIFEST_NAME} to resume from.')
+        fold_dir.mkdir(parents=True, exist_ok=True)
+        dropout = [float(x) for x in str(config['dropout']).split(',')] if config['dropout'] else None
+        return fold_fasta(fasta_dict_no_gaps, fold_dir, n_variants=n_variants, dropout=dropout, **(fold_options or {}))
+
+    def conserved(config):
+        fold_dir = run_stage(cache, counts, 'structures', config, lambda: structures(config))
+        if config['drop_inserts']:
+            return drop_inserts_from_structures(fold_dir, fasta_dict_full)
+        return fold_dir
+
+    def pairs(config):
+        structure_dir = run_stage(cache, counts, 'conserved', config, lambda: conserved(config))
+        pair_df, samples_df = align_bootstrap_structures(
+            list_structure_files(structure_dir),
+            n_threads=n_threads,
+            n_bootstraps=max_bootstraps[stage_key('pairs', config)],
+        )
+        pair_dir = out_dir / 'pair_results' / f'dropout-{config["dropout"] or "none"}_{"noinserts" if config["drop_inserts"] else "inserts"}'
+        save_pair_results(pair_df, samples_df, pair_dir)
+        return pair_df, samples_df
+
+    def matrices(config):
+        pair_df, samples_df = run_stage(cache, counts, 'pairs', config, lambda: pairs(config))
+        return bootstrap_tensor_from_pair_results(pair_df, samples_df, metric=config['metric'])
+
+    def trees(config):
+        bootstrap_matrices = run_stage(cache, counts, 'matrices', config, lambda: matrices(config))
+        return build_bootstrap_trees(bootstrap_matrices, n_threads=n_threads, method=config['method'])
+
+    def consensus(config):
+        n_bootstraps = config['n_bootstraps']
+        bootstrap_matrices = run_stage(cache, counts, 'matrices', config, lambda: matrices(config)).head(n_bootstraps)
+        bootstrap_trees = run_stage(cache, counts, 'trees', config, lambda: trees(config))[:n_bootstraps]
+        config_dir = out_dir / config_name(config)
+        config_dir.mkdir(parents=True, exist_ok=True)
+        write_bootstrap_matrices(bootstrap_matrices, config_dir)
+        summarise_bootstrap_trees(bootstrap_trees, bootstrap_matrices, config_dir, support=config['support'], n_threads=n_threads)
+        return config_dir
+
+    cache = {}
+    counts = {}
+    summary = []
+    try:
+        for config in configs:
+            print(f'Sweep configuration {config_name(config)}')
+            config_dir = run_stage(cache, counts, 'consensus', config, lambda: consensus(config))
+            summary.append(dict(config, name=config_name(config), out_dir=str(config_dir)))
+    finally:
+        # Release the arrays behind every cached matrix stage
+        for key, value in cache.items():
+            if key[0] == 'matrices':
+                value.close()
+
+    with open(out_dir / 'sweep_summary.json', 'w') as f:
+        json.dump({'configurations': summary, 'stages': {stage: {'computed': computed, 'requested': requested} for stage, (computed, requested) in counts.items()}}, f, indent=2)
+
+    for stage in STAGE_KEYS:
+        computed, requested = counts.get(stage, [0, 0])
+        print(f'{stage:>10}: computed {computed}, reused {requested - computed}')
+
+    return summary
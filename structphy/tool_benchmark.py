@@ -0,0 +1,160 @@
+from pathlib import Path
+from typing import Callable, List, Tuple
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import click
+
+from structphy.install_executables import BUILD_VARIANTS, BUILDS_DIR_NAME, build_variant, fetch_source
+
+# Builds TMalign or FastME with each of BUILD_VARIANTS, times them on a fixed reference
+# workload and checks their output matches the baseline build byte for byte. The fastest
+# variant with matching output can then replace the tool in .structphy.
+
+EXAMPLE_STRUCTS = Path(__file__).parent / 'example_data' / 'kindom_structs'
+
+
+def reference_pairs(structdir: Path, n_pairs: int, seed: int = 0) -> Tuple[List[tuple], List[tuple]]:
+    # (benchmark pairs, training pairs) of different proteins, the same ones every run for a given seed.
+    # Both come from one shuffle so no pair is in both, a profile guided build is never timed on what it trained on.
+    # With too few structures for two full sets each gets half.
+    structures = sorted(structdir.glob('*.pdb'))
+    pairs = [(a, b) for a, b in itertools.combinations(structures, 2) if a.name.split('#')[0] != b.name.split('#')[0]]
+    random.Random(seed).shuffle(pairs)
+    n_pairs = min(n_pairs, len(pairs) // 2)
+    return pairs[:n_pairs], pairs[n_pairs:2 * n_pairs]
+
+def tmalign_workload(pairs: List[tuple]) -> Callable[[Path], List[str]]:
+
+    def run(executable: Path) -> List[str]:
+        outputs = []
+        for pdb1, pdb2 in pairs:
+            completed = subprocess.run([str(executable), str(pdb1), str(pdb2)], capture_output=True, text=True, check=True)
+            # The timing line is the only part of the output expected to differ between builds
+            outputs.append('\n'.join(line for line in completed.stdout.splitlines() if 'CPU time' not in line))
+        return outputs
+    return run
+
+def fastme_workload(sizes: List[int], seed: int) -> Callable[[Path], List[str]]:
+    import numpy as np
+    from structphy.generate_trees import phylip_from_array
+
+    # Distances between random points, so the matrices are close to tree-like but not exactly
+    rng = np.random.default_rng(seed)
+    matrices = []
+    for n in sizes:
+        points = rng.random((n, 5))
+        distances = np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=-1))
+        matrices.append(phylip_from_array([f't{i}' for i in range(n)], distances))
+
+    def run(executable: Path) -> List[str]:
+        outputs = []
+        with tempfile.TemporaryDirectory() as tmp:
+            phylip_file, tree_file = Path(tmp) / 'matrix.phylip', Path(tmp) / 'tree.newick'
+            for matrix in matrices:
+                phylip_file.write_text(matrix)
+                subprocess.run([str(executable), '-i', str(phylip_file), '-o', str(tree_file), '-I', '/dev/null', '-O', '/dev/null', '-s', '-m', 'NJ'], capture_output=True, check=True)
+                outputs.append(tree_file.read_text().strip())
+        return outputs
+    return run
+
+def time_workload(run: Callable[[Path], List[str]], executable: Path, repeats: int):
+    # Best of several runs, outputs from the first
+    outputs = None
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = run(executable)
+        best = min(best, time.perf_counter() - start)
+        outputs = outputs if outputs is not None else result
+    return best, outputs
+
+@click.command()
+@click.option('--tool', type=click.Choice(['TMalign', 'fastme']), default='TMalign', show_default=True)
+@click.option('--source', type=click.Path(exists=True, dir_okay=False, path_type=Path, resolve_path=True), help='Local TMalign.cpp or FastME tarball to build from. Defaults to the copy in .structphy/sources.')
+@click.option('--variants', type=str, default=','.join(BUILD_VARIANTS), show_default=True)
+@click.option('-d', '--structdir', type=click.Path(exists=True, file_okay=False, path_type=Path, resolve_path=True), default=EXAMPLE_STRUCTS, help='Structures for the TMalign reference pairs, the bundled kinase set by default.')
+@click.option('--pairs', 'n_pairs', type=int, default=20, show_default=True, help='TMalign reference pairs. Profile guided builds train on as many other pairs, none of them timed.')
+@click.option('--repeats', type=int, default=3, show_default=True)
+@click.option('--select/--no_select', default=True, show_default=True, help='Install the fastest variant whose output matches the baseline.')
+def main(tool: str, source: Path, variants: str, structdir: Path, n_pairs: int, repeats: int, select: bool):
+    from structphy.__main__ import setup_working_dir, TMALIGN_URL, FASTME_URL
+
+    setup_working_dir()
+    CACHE_DIR = Path(os.environ["STRUCTPHY_CACHE_DIR"])
+
+    variants = [variant.strip() for variant in variants.split(',') if variant.strip()]
+    unknown = [variant for variant in variants if variant not in BUILD_VARIANTS]
+    if unknown:
+        raise click.BadParameter(f'unknown variants {", ".join(unknown)}, expected some of {", ".join(BUILD_VARIANTS)}', param_hint='--variants')
+    # Every variant is checked against the baseline
+    if 'baseline' not in variants:
+        variants = ['baseline'] + variants
+
+    try:
+        source = fetch_source(CACHE_DIR, TMALIGN_URL if tool == 'TMalign' else FASTME_URL, source)
+    except Exception as e:
+        raise click.ClickException(f'No {tool} source in {CACHE_DIR / "sources"} and it could not be downloaded ({e}), pass one with --source')
+
+    if tool == 'TMalign':
+        benchmark_pairs, training_pairs = reference_pairs(structdir, n_pairs)
+        if not benchmark_pairs:
+            raise click.ClickException(f'Not enough structures in {structdir} for disjoint benchmark and training pairs')
+        benchmark = tmalign_workload(benchmark_pairs)
+        train = tmalign_workload(training_pairs)
+        training = json.dumps(sorted([pdb1.name, pdb2.name] for pdb1, pdb2 in training_pairs))
+    else:
+        benchmark = fastme_workload([100, 200, 400], seed=0)
+        train = fastme_workload([100, 200, 400], seed=1)
+        training = 'fastme-100,200,400-seed1'
+
+    results = {}
+    for variant in variants:
+        click.echo(f'Building {tool} {variant}')
+        try:
+            executable = build_variant(CACHE_DIR, tool, source, variant, train=train, training=training)
+        except subprocess.CalledProcessError as e:
+            click.echo(f'  build failed: {(e.stderr or "").strip().splitlines()[-1:] or e}', err=True)
+            continue
+        seconds, outputs = time_workload(benchmark, executable, repeats)
+        results[variant] = {'executable': executable, 'seconds': seconds, 'outputs': outputs}
+
+    if 'baseline' not in results:
+        raise click.ClickException('The baseline build failed, nothing to compare against')
+    baseline = results['baseline']
+
+    click.echo(f'{"variant":>16} {"seconds":>9} {"speedup":>8}  output')
+    for variant, result in results.items():
+        result['matches'] = result['outputs'] == baseline['outputs']
+        result['speedup'] = baseline['seconds'] / result['seconds']
+        click.echo(f'{variant:>16} {result["seconds"]:9.3f} {result["speedup"]:7.2f}x  {"same" if result["matches"] else "DIFFERENT"}')
+
+    fastest = min((variant for variant, result in results.items() if result['matches']), key=lambda variant: results[variant]['seconds'])
+    click.echo(f'Fastest with the same output: {fastest}')
+
+    if select:
+        # Replace the tool through a rename so a running pipeline never sees a half copied binary
+        installed = CACHE_DIR / tool
+        shutil.copy(results[fastest]['executable'], installed.with_suffix('.tmp'))
+        os.chmod(installed.with_suffix('.tmp'), 0o777)
+        installed.with_suffix('.tmp').replace(installed)
+
+        selected_path = CACHE_DIR / BUILDS_DIR_NAME / 'selected.json'
+        selected = json.loads(selected_path.read_text()) if selected_path.exists() else {}
+        selected[tool] = {
+            'variant': fastest,
+            'executable': str(results[fastest]['executable']),
+            'seconds': results[fastest]['seconds'],
+            'speedup': results[fastest]['speedup'],
+        }
+        selected_path.write_text(json.dumps(selected, indent=2))
+        click.echo(f'Installed {tool} {fastest} as {installed}')
+
+if __name__ == '__main__':
+    main()
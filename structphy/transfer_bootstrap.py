@@ -0,0 +1,233 @@
+from typing import Dict, FrozenSet, List, Tuple
+from multiprocessing import Pool
+import math
+
+from ete3 import Tree
+from tqdm.auto import tqdm
+
+# Transfer bootstrap expectation (Lemoine et al. 2018). For a branch b of the reference tree with
+# p taxa on its smaller side, the transfer index is the fewest taxa that have to move for b to
+# appear in a bootstrap tree, and the branch support is 1 - transfer index / (p - 1).
+#
+# Computing the transfer index of every branch naively compares every pair of branches. Instead,
+# following Truszkowski, Gascuel and Swenson (2019), taxa of the reference clade are marked one at
+# a time: marking a taxon changes the distance to every bootstrap clade on its path to the root,
+# which is a few range updates on a heavy path decomposition of the bootstrap tree. Reference
+# clades are visited small-to-large so each taxon is only marked O(log n) times, O(n log^3 n) per tree.
+
+
+def leaf_name(node) -> str:
+    return node.name.split(':')[0].strip()
+
+def tree_to_arrays(tree: Tree) -> Tuple[List[int], List[List[int]], List[str]]:
+    # Preorder node ids, returns (parent, children, leaf name or None)
+    nodes = list(tree.traverse('preorder'))
+    node_id = {node: i for i, node in enumerate(nodes)}
+    parent = [node_id[node.up] if node.up is not None else -1 for node in nodes]
+    children = [[node_id[child] for child in node.children] for node in nodes]
+    names = [leaf_name(node) if node.is_leaf() else None for node in nodes]
+    return parent, children, names
+
+class MinMaxSegmentTree:
+    # Range add with global min and max, over positions 0..size-1.
+    # Excluded positions still take updates but never count towards the min or max.
+
+    def __init__(self, values: List[float], excluded: Tuple[int, ...] = ()):
+        self.size = len(values)
+        self.mn = [0.0] * (4 * self.size)
+        self.mx = [0.0] * (4 * self.size)
+        self.lazy = [0.0] * (4 * self.size)
+        self._build(1, 0, self.size - 1, values, set(excluded))
+
+    def _build(self, node, lo, hi, values, excluded):
+        if lo == hi:
+            if lo in excluded:
+                self.mn[node], self.mx[node] = math.inf, -math.inf
+            else:
+                self.mn[node] = self.mx[node] = values[lo]
+            return
+        mid = (lo + hi) // 2
+        self._build(2 * node, lo, mid, values, excluded)
+        self._build(2 * node + 1, mid + 1, hi, values, excluded)
+        self.mn[node] = min(self.mn[2 * node], self.mn[2 * node + 1])
+        self.mx[node] = max(self.mx[2 * node], self.mx[2 * node + 1])
+
+    def add(self, left, right, delta, node=1, lo=0, hi=None):
+        if hi is None:
+            hi = self.size - 1
+        if right < lo or hi < left:
+            return
+        if left <= lo and hi <= right:
+            self.mn[node] += delta
+            self.mx[node] += delta
+            self.lazy[node] += delta
+            return
+        mid = (lo + hi) // 2
+        self.add(left, right, delta, 2 * node, lo, mid)
+        self.add(left, right, delta, 2 * node + 1, mid + 1, hi)
+        self.mn[node] = min(self.mn[2 * node], self.mn[2 * node + 1]) + self.lazy[node]
+        self.mx[node] = max(self.mx[2 * node], self.mx[2 * node + 1]) + self.lazy[node]
+
+    def min(self):
+        return self.mn[1]
+
+    def max(self):
+        return self.mx[1]
+
+class BootstrapClades:
+    # Heavy path decomposition of a bootstrap tree. For the currently marked set of reference taxa A
+    # it keeps, for every bootstrap clade C, s(C) = |C| - 2|A ∩ C| so that |A Δ C| = |A| + s(C).
+
+    def __init__(self, bootstrap_tree: Tree, taxa: Dict[str, int]):
+        parent, children, names = tree_to_arrays(bootstrap_tree)
+        n_nodes = len(parent)
+        self.parent = parent
+
+        # Taxa missing from the reference tree (e.g. the fake outgroup) count for nothing
+        n_taxa = [0] * n_nodes
+        subtree_size = [1] * n_nodes
+        self.taxon_node = {}
+        for v in reversed(range(n_nodes)):
+            if names[v] is not None and names[v] in taxa:
+                n_taxa[v] = 1
+                self.taxon_node[taxa[names[v]]] = v
+            for c in children[v]:
+                n_taxa[v] += n_taxa[c]
+                subtree_size[v] += subtree_size[c]
+
+        # Positions along heavy paths, each path is a contiguous range
+        self.head = [0] * n_nodes
+        self.pos = [0] * n_nodes
+        next_pos = 0
+        stack = [(0, 0)]
+        while stack:
+            v, head = stack.pop()
+            self.head[v] = head
+            self.pos[v] = next_pos
+            next_pos += 1
+            if children[v]:
+                heavy = max(children[v], key=lambda c: subtree_size[c])
+                for c in children[v]:
+                    if c != heavy:
+                        stack.append((c, c))
+                stack.append((heavy, head))
+
+        # The root clade is every taxon, not a branch, so it never takes part in the min or max
+        values = [0.0] * n_nodes
+        for v in range(n_nodes):
+            values[self.pos[v]] = n_taxa[v]
+        self.segments = MinMaxSegmentTree(values, excluded=(self.pos[0],))
+
+    def mark(self, taxon: int, delta: int):
+        # delta -2 marks the taxon, +2 unmarks it. Every clade containing it is on its path to the root.
+        v = self.taxon_node.get(taxon, -1)
+        while v != -1:
+            head = self.head[v]
+            self.segments.add(self.pos[head], self.pos[v], delta)
+            v = self.parent[head]
+
+    def transfer_index(self, n_marked: int, n_taxa: int) -> float:
+        # min over clades of min(|A Δ C|, |A Δ complement of C|)
+        return min(n_marked + self.segments.min(), n_taxa - n_marked - self.segments.max())
+
+def reference_clades(reference_tree: Tree) -> Tuple[List[FrozenSet[str]], Dict[str, int]]:
+    taxa = {name: i for i, name in enumerate(sorted(leaf_name(leaf) for leaf in reference_tree.get_leaves()))}
+    clades = [frozenset(leaf_name(leaf) for leaf in node.get_leaves()) for node in reference_tree.traverse('preorder')]
+    return clades, taxa
+
+def transfer_indices(reference_tree: Tree, bootstrap_tree: Tree) -> List[float]:
+    # Transfer index of every reference node's clade against one bootstrap tree, in preorder
+    parent, children, names = tree_to_arrays(reference_tree)
+    _, taxa = reference_clades(reference_tree)
+    n_taxa = len(taxa)
+    n_nodes = len(parent)
+    bootstrap = BootstrapClades(bootstrap_tree, taxa)
+
+    # Taxa of each reference clade are a contiguous range of the preorder taxon order
+    taxon_order = [taxa[names[v]] for v in range(n_nodes) if names[v] is not None]
+    first = [0] * n_nodes
+    n_below = [0] * n_nodes
+    counter = 0
+    for v in range(n_nodes):
+        first[v] = counter
+        if names[v] is not None:
+            counter += 1
+    for v in reversed(range(n_nodes)):
+        n_below[v] = 1 if names[v] is not None else sum(n_below[c] for c in children[v])
+
+    heavy = [max(children[v], key=lambda c: n_below[c]) if children[v] else -1 for v in range(n_nodes)]
+
+    def mark_range(v, delta):
+        for taxon in taxon_order[first[v]:first[v] + n_below[v]]:
+            bootstrap.mark(taxon, delta)
+
+    # Small-to-large: light children are solved and cleared first, the heavy child's marks are kept
+    indices = [0.0] * n_nodes
+    stack = [(0, True, False)]
+    while stack:
+        v, keep, expanded = stack.pop()
+        if not expanded:
+            stack.append((v, keep, True))
+            if heavy[v] != -1:
+                stack.append((heavy[v], True, False))
+            for c in children[v]:
+                if c != heavy[v]:
+                    stack.append((c, False, False))
+            continue
+
+        for c in children[v]:
+            if c != heavy[v]:
+                mark_range(c, -2)
+        if names[v] is not None:
+            bootstrap.mark(taxa[names[v]], -2)
+
+        indices[v] = bootstrap.transfer_index(n_below[v], n_taxa)
+
+        if not keep:
+            mark_range(v, +2)
+
+    return indices
+
+_reference_newick = None
+
+def _set_reference(reference_newick: str):
+    global _reference_newick
+    _reference_newick = reference_newick
+
+def transfer_indices_newick(bootstrap_newick: str) -> List[float]:
+    # Pool worker, the reference tree is sent once per worker by _set_reference
+    return transfer_indices(Tree(_reference_newick), Tree(bootstrap_newick))
+
+def transfer_indices_pair(trees_newick: Tuple[str, str]) -> List[float]:
+    # Pool worker for pools shared between jobs, the reference tree comes with every task
+    reference_newick, bootstrap_newick = trees_newick
+    return transfer_indices(Tree(reference_newick), Tree(bootstrap_newick))
+
+def transfer_supports(bootstrap_trees_newick: List[str], base_tree_newick: str, n_threads: int = 1, pool: Pool = None) -> Dict[FrozenSet[str], float]:
+    # Mean transfer support of every clade of the base tree over the bootstrap trees
+    base_tree = Tree(base_tree_newick)
+    clades, taxa = reference_clades(base_tree)
+    n_taxa = len(taxa)
+
+    def accumulate(all_indices):
+        totals = [0.0] * len(clades)
+        for indices in tqdm(
+            all_indices,
+            total=len(bootstrap_trees_newick),
+            desc='Applying transfer bootstraps',
+            ascii=True,
+            position=0,
+            ):
+            for i, (clade, index) in enumerate(zip(clades, indices)):
+                p = min(len(clade), n_taxa - len(clade))
+                # Trivial branches (a single taxon on one side) are always supported
+                totals[i] += 1.0 if p <= 1 else 1 - index / (p - 1)
+        return totals
+
+    if pool is not None:
+        totals = accumulate(pool.imap_unordered(transfer_indices_pair, [(base_tree_newick, newick) for newick in bootstrap_trees_newick]))
+    else:
+        with Pool(n_threads, initializer=_set_reference, initargs=(base_tree_newick,)) as pool:
+            totals = accumulate(pool.imap_unordered(transfer_indices_newick, bootstrap_trees_newick))
+
+    return {clade: total / len(bootstrap_trees_newick) for clade, total in zip(clades, totals)}